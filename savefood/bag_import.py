@@ -0,0 +1,83 @@
+# bag_import.py
+import csv
+import io
+import itertools
+import json
+import os
+from typing import BinaryIO, Iterator, List, Tuple
+
+from pydantic import ValidationError
+
+from schemas import SurpriseBagCreate
+
+IMPORT_CHUNK_SIZE = int(os.getenv("BAG_IMPORT_CHUNK_SIZE", "500"))  # rows per insert transaction
+IMPORT_MAX_ERRORS = int(os.getenv("BAG_IMPORT_MAX_ERRORS", "100"))  # rejected rows listed in the report
+IMPORT_FORMATS = ("csv", "ndjson")
+IMAGE_URL_SEPARATOR = "|"  # CSV has no lists: image_urls holds URLs joined by this
+
+def detect_format(filename: str, content_type: str) -> str:
+    """csv or ndjson, from the file extension or else the content type"""
+    name = (filename or "").lower()
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in (content_type or ""):
+        return "ndjson"
+    return "csv"
+
+def read_records(file: BinaryIO, format: str) -> Iterator[Tuple[int, dict]]:
+    """Yield (row number, fields) one record at a time; unparseable rows yield a ValueError.
+
+    Rows are numbered from 1 and exclude the CSV header, so the report
+    matches what the user sees in a spreadsheet.
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", errors="replace", newline="")
+    if format == "ndjson":
+        for number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                fields = json.loads(line)
+                if not isinstance(fields, dict):
+                    raise ValueError("Expected a JSON object")
+                yield number, fields
+            except ValueError as e:
+                yield number, ValueError(f"Invalid JSON: {str(e)}")
+        return
+
+    reader = csv.DictReader(text)
+    number = 0
+    while True:
+        number += 1
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield number, ValueError(f"Invalid CSV: {str(e)}")
+            continue
+        if None in row:
+            yield number, ValueError("More fields than header columns")
+            continue
+        fields = {key: value for key, value in row.items() if value not in ("", None)}
+        if "image_urls" in fields:
+            fields["image_urls"] = [url.strip() for url in fields["image_urls"].split(IMAGE_URL_SEPARATOR) if url.strip()]
+        yield number, fields
+
+def validate_chunk(records: Iterator[Tuple[int, dict]], size: int = IMPORT_CHUNK_SIZE) -> Tuple[int, List[Tuple[int, SurpriseBagCreate]], List[dict]]:
+    """Take up to size records and validate them.
+
+    Returns the number of records consumed, (row number, bag) for the valid
+    ones and an error entry per rejected row; blocking, so call it off the
+    event loop.
+    """
+    consumed, bags, errors = 0, [], []
+    for number, fields in itertools.islice(records, size):
+        consumed += 1
+        if isinstance(fields, Exception):
+            errors.append({"row": number, "errors": [str(fields)]})
+            continue
+        try:
+            bags.append((number, SurpriseBagCreate.model_validate(fields)))
+        except ValidationError as e:
+            errors.append({"row": number, "errors": [
+                f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+            ]})
+    return consumed, bags, errors
@@ -0,0 +1,172 @@
+# benchmarks/bench_async_sessions.py
+"""Compare request latency with blocking vs async database sessions.
+
+Both apps serve the same two endpoints from one event loop: a cheap bag
+listing and a deliberately slow aggregate query. The "sync" app uses a
+blocking Session inside ``async def`` handlers (the previous router
+pattern), the "async" app uses AsyncSession. Under concurrent load the
+slow query stalls every other request on the sync app.
+
+Both engines get a pool as large as the client concurrency. With a smaller
+pool the sync app does not just slow down, it deadlocks: a checkout blocks
+the event loop that would have returned the connections.
+
+Run from the savefood directory:
+
+    python benchmarks/bench_async_sessions.py --requests 300 --concurrency 8
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Base, to_async_url  # noqa: E402
+from models import Business, SurpriseBag, User, UserRole  # noqa: E402
+
+SLOW_QUERY = text(
+    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c LIMIT 300000) "
+    "SELECT count(*) FROM c"
+)
+
+
+def seed(url: str, bags: int) -> None:
+    engine = create_engine(url)
+    Base.metadata.create_all(bind=engine)
+    with Session(engine) as db:
+        owner = User(
+            id=uuid.uuid4(),
+            email="bench@example.com",
+            password_hash="x",
+            name="Bench",
+            role=UserRole.business_owner,
+        )
+        db.add(owner)
+        db.add(Business(id=owner.id, name="Bench Shop", is_approved=True))
+        now = datetime.utcnow()
+        db.add_all(
+            SurpriseBag(
+                business_id=owner.id,
+                title=f"Bag {i}",
+                original_price=10,
+                discount_price=5,
+                quantity_available=10,
+                quantity_sold=0,
+                pickup_start=now,
+                pickup_end=now + timedelta(hours=2),
+            )
+            for i in range(bags)
+        )
+        db.commit()
+    engine.dispose()
+
+
+def build_sync_app(url: str, pool_size: int) -> FastAPI:
+    engine = create_engine(url, pool_size=pool_size, connect_args={"check_same_thread": False})
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app = FastAPI()
+
+    @app.get("/bags")
+    async def list_bags(db: Session = Depends(get_db)):
+        return [bag.id for bag in db.execute(select(SurpriseBag).limit(20)).scalars()]
+
+    @app.get("/slow")
+    async def slow(db: Session = Depends(get_db)):
+        return db.execute(SLOW_QUERY).scalar()
+
+    return app
+
+
+def build_async_app(url: str, pool_size: int) -> FastAPI:
+    engine = create_async_engine(to_async_url(url), pool_size=pool_size)
+    AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    async def get_async_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    app = FastAPI()
+
+    @app.get("/bags")
+    async def list_bags(db: AsyncSession = Depends(get_async_db)):
+        return [bag.id for bag in (await db.execute(select(SurpriseBag).limit(20))).scalars()]
+
+    @app.get("/slow")
+    async def slow(db: AsyncSession = Depends(get_async_db)):
+        return (await db.execute(SLOW_QUERY)).scalar()
+
+    return app
+
+
+async def run_load(app: FastAPI, requests: int, concurrency: int, slow_every: int) -> list:
+    """Return latencies (seconds) of the fast requests"""
+    gate = asyncio.Semaphore(concurrency)
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i):
+            path = "/slow" if slow_every and i % slow_every == 0 else "/bags"
+            async with gate:
+                start = time.perf_counter()
+                response = await client.get(path)
+                elapsed = time.perf_counter() - start
+            response.raise_for_status()
+            if path == "/bags":
+                latencies.append(elapsed)
+
+        await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--slow-every", type=int, default=10, help="every Nth request runs the slow query")
+    parser.add_argument("--bags", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        seed(url, args.bags)
+
+        print(f"{'mode':<6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for name, build in (("sync", build_sync_app), ("async", build_async_app)):
+            app = build(url, args.concurrency)
+            # Warm-up pass fills the connection pool so connects are not measured
+            asyncio.run(run_load(app, args.concurrency * 2, args.concurrency, 0))
+            latencies = asyncio.run(run_load(app, args.requests, args.concurrency, args.slow_every))
+            print(
+                f"{name:<6} {statistics.median(latencies) * 1000:8.1f} "
+                f"{percentile(latencies, 99) * 1000:8.1f} {max(latencies) * 1000:8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
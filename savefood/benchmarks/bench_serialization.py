@@ -0,0 +1,133 @@
+# benchmarks/bench_serialization.py
+"""Compare CPU time per list response for ORM + Pydantic vs column rows + orjson.
+
+Both endpoints return the same page of bags in the same JSON. The "orm"
+endpoint hydrates SurpriseBag objects and lets FastAPI validate them
+through response_model=List[SurpriseBagOut] (the previous list_bags); the
+"rows" endpoint selects SurpriseBagOut's columns and encodes the rows with
+serialization.dump_rows. Requests run one at a time, so process CPU time
+divided by requests is the cost of one response.
+
+Run from the savefood directory:
+
+    python benchmarks/bench_serialization.py --requests 200 --page-size 500
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Base, to_async_url  # noqa: E402
+from models import Business, SurpriseBag, User, UserRole  # noqa: E402
+from schemas import SurpriseBagOut  # noqa: E402
+from serialization import columns, dump_rows, json_response  # noqa: E402
+
+
+def seed(url: str, bags: int) -> None:
+    engine = create_engine(url)
+    Base.metadata.create_all(bind=engine)
+    with Session(engine) as db:
+        owner = User(
+            id=uuid.uuid4(),
+            email="bench@example.com",
+            password_hash="x",
+            name="Bench",
+            role=UserRole.business_owner,
+        )
+        db.add(owner)
+        db.add(Business(id=owner.id, name="Bench Shop", is_approved=True))
+        now = datetime.utcnow()
+        db.add_all(
+            SurpriseBag(
+                business_id=owner.id,
+                title=f"Bag {i}",
+                description="Bread, pastries and whatever else is left at closing time",
+                original_price=10,
+                discount_price=5,
+                quantity_available=10,
+                quantity_sold=0,
+                pickup_start=now,
+                pickup_end=now + timedelta(hours=2),
+                image_urls=[f"https://example.com/bags/{i}.jpg"],
+            )
+            for i in range(bags)
+        )
+        db.commit()
+    engine.dispose()
+
+
+def build_app(url: str, page_size: int) -> FastAPI:
+    engine = create_async_engine(to_async_url(url))
+    AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    async def get_async_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    app = FastAPI()
+
+    @app.get("/orm", response_model=List[SurpriseBagOut])
+    async def list_orm(db: AsyncSession = Depends(get_async_db)):
+        query = select(SurpriseBag).order_by(SurpriseBag.created_at.desc(), SurpriseBag.id.desc()).limit(page_size)
+        return (await db.execute(query)).scalars().all()
+
+    @app.get("/rows", response_model=List[SurpriseBagOut])
+    async def list_rows(db: AsyncSession = Depends(get_async_db)):
+        query = (
+            select(*columns(SurpriseBag, SurpriseBagOut))
+            .order_by(SurpriseBag.created_at.desc(), SurpriseBag.id.desc())
+            .limit(page_size)
+        )
+        return json_response(dump_rows((await db.execute(query)).all()))
+
+    return app
+
+
+async def run(app: FastAPI, path: str, requests: int) -> tuple:
+    """Return (CPU seconds, wall seconds, last body) for requests sequential GETs"""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(5):
+            (await client.get(path)).raise_for_status()
+        cpu, wall = time.process_time(), time.perf_counter()
+        for _ in range(requests):
+            response = await client.get(path)
+            response.raise_for_status()
+        return time.process_time() - cpu, time.perf_counter() - wall, response.json()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        seed(url, args.page_size)
+        app = build_app(url, args.page_size)
+
+        bodies = {}
+        print(f"{'path':<6} {'cpu ms/resp':>12} {'wall ms/resp':>13}")
+        for path in ("orm", "rows"):
+            cpu, wall, bodies[path] = asyncio.run(run(app, f"/{path}", args.requests))
+            print(f"{path:<6} {cpu / args.requests * 1000:12.2f} {wall / args.requests * 1000:13.2f}")
+        if bodies["orm"] != bodies["rows"]:
+            raise SystemExit("Responses differ between the two paths")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# benchmarks/bench_sqlite_writes.py
+"""Compare SQLite write throughput with and without the production profile.
+
+Each worker repeatedly runs an order-shaped transaction: read the customer,
+reserve one unit of a bag with a conditional UPDATE, and insert a
+notification. "default" is SQLite as it comes (rollback journal,
+synchronous=FULL, every pooled connection writing). "production" is the
+profile from database.py: WAL and pragmas on every connection, writes
+serialized through one writer connection.
+
+Run from the savefood directory:
+
+    python benchmarks/bench_sqlite_writes.py --workers 32 --transactions 20
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import (  # noqa: E402
+    Base,
+    RoutingSession,
+    apply_sqlite_pragmas,
+    create_db_engine,
+    create_writer_engine,
+)
+from models import Business, Notification, NotificationType, SurpriseBag, User, UserRole  # noqa: E402
+
+
+def seed(url: str, stock: int):
+    engine = create_engine(url)
+    Base.metadata.create_all(bind=engine)
+    with Session(engine) as db:
+        owner = User(id=uuid.uuid4(), email="owner@bench", password_hash="x", name="Owner", role=UserRole.business_owner)
+        customer = User(id=uuid.uuid4(), email="customer@bench", password_hash="x", name="Customer", role=UserRole.customer)
+        db.add_all([owner, customer])
+        db.add(Business(id=owner.id, name="Bench Shop", is_approved=True))
+        now = datetime.utcnow()
+        bag = SurpriseBag(
+            business_id=owner.id,
+            title="Bench Bag",
+            original_price=10,
+            discount_price=5,
+            quantity_available=stock,
+            quantity_sold=0,
+            pickup_start=now,
+            pickup_end=now + timedelta(hours=2),
+        )
+        db.add(bag)
+        db.commit()
+        ids = customer.id, bag.id
+    engine.dispose()
+    return ids
+
+
+def build_sessionmaker(url: str, profile: str, workers: int):
+    if profile == "default":
+        engine = create_db_engine(url, name=f"bench_{profile}", is_async=True, pool_size=workers, connect_args={"timeout": 5})
+        return engine, [engine], async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    engine = create_db_engine(url, name=f"bench_{profile}", is_async=True, pool_size=workers)
+    writer = create_writer_engine(url, name=f"bench_{profile}_writer", is_async=True)
+    apply_sqlite_pragmas(engine)
+    apply_sqlite_pragmas(writer, writer=True)
+    factory = async_sessionmaker(
+        engine, autoflush=False, expire_on_commit=False,
+        sync_session_class=RoutingSession,
+        reader=engine.sync_engine, writer=writer.sync_engine,
+    )
+    return engine, [engine, writer], factory
+
+
+async def run(factory, customer_id, bag_id, workers: int, transactions: int) -> dict:
+    committed = 0
+    locked = 0
+
+    async def worker():
+        nonlocal committed, locked
+        for _ in range(transactions):
+            async with factory() as db:
+                try:
+                    await db.scalar(select(User).where(User.id == customer_id))
+                    await db.execute(
+                        update(SurpriseBag)
+                        .where(SurpriseBag.id == bag_id, SurpriseBag.quantity_available >= 1)
+                        .values(quantity_available=SurpriseBag.quantity_available - 1)
+                    )
+                    db.add(Notification(
+                        user_id=customer_id,
+                        type=NotificationType.order_confirmation,
+                        title="Order placed",
+                        message="Your bag is reserved",
+                    ))
+                    await db.commit()
+                    committed += 1
+                except OperationalError as exc:
+                    await db.rollback()
+                    if "locked" not in str(exc):
+                        raise
+                    locked += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    elapsed = time.perf_counter() - start
+    return {"committed": committed, "locked": locked, "seconds": elapsed}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--transactions", type=int, default=20, help="transactions per worker")
+    args = parser.parse_args()
+    # Queueing on the writer is the point of the profile; skip the slow-wait warnings
+    logging.getLogger("database").setLevel(logging.ERROR)
+
+    print(f"{'profile':<11} {'commits':>8} {'locked':>7} {'seconds':>8} {'tx/s':>8}")
+    for profile in ("default", "production"):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+            customer_id, bag_id = seed(url, stock=args.workers * args.transactions)
+            _, engines, factory = build_sessionmaker(url, profile, args.workers)
+
+            async def bench():
+                try:
+                    return await run(factory, customer_id, bag_id, args.workers, args.transactions)
+                finally:
+                    for engine in engines:
+                        await engine.dispose()
+
+            result = asyncio.run(bench())
+            rate = result["committed"] / result["seconds"] if result["seconds"] else 0.0
+            print(
+                f"{profile:<11} {result['committed']:>8} {result['locked']:>7} "
+                f"{result['seconds']:>8.2f} {rate:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# cache.py
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import Response
+
+from pagination import NEXT_CURSOR_HEADER
+
+logger = logging.getLogger(__name__)
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")  # memory, redis or none
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/1")
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+
+class CacheBackend:
+    """Async key/value store for JSON-serializable values.
+
+    Catalogue entries are keyed by catalog.versioned_key, so a write moves
+    readers to new keys and nothing is deleted; old entries age out with
+    their TTL.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    async def delete(self, *keys: str):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class MemoryCache(CacheBackend):
+    """Per-process LRU with a TTL on every entry"""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.evictions = 0
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key, value, ttl=None):
+        self.entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {**super().stats(), "entries": len(self.entries), "evictions": self.evictions}
+
+class RedisCache(CacheBackend):
+    """Shared cache for several API processes; size is bounded by the server's maxmemory policy"""
+
+    def __init__(self, url: str = CACHE_URL, ttl: float = CACHE_TTL_SECONDS, prefix: str = "savefood:"):
+        super().__init__()
+        import redis.asyncio as redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get(self, key):
+        raw = await self.client.get(self.prefix + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    async def set(self, key, value, ttl=None):
+        await self.client.set(self.prefix + key, json.dumps(value), px=int((ttl or self.ttl) * 1000))
+
+    async def delete(self, *keys):
+        if keys:
+            await self.client.delete(*(self.prefix + key for key in keys))
+
+class NullCache(CacheBackend):
+    """Caching switched off: every read goes to the database"""
+
+    async def get(self, key):
+        self.misses += 1
+        return None
+
+    async def set(self, key, value, ttl=None):
+        pass
+
+    async def delete(self, *keys):
+        pass
+
+CACHE_BACKENDS = {
+    "memory": MemoryCache,
+    "redis": RedisCache,
+    "none": NullCache,
+}
+
+def create_cache(backend: str = CACHE_BACKEND) -> CacheBackend:
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(f"Unknown CACHE_BACKEND: {backend}")
+    logger.info(f"Using {backend} cache")
+    return CACHE_BACKENDS[backend]()
+
+cache = create_cache()
+
+def entity_key(namespace: str, entity_id) -> str:
+    return f"{namespace}:{entity_id}"
+
+def list_key(namespace: str, *params) -> str:
+    """Key for one page of a list; pass it through versioned_key like entity keys"""
+    return f"{namespace}:list:" + ":".join(str(param) for param in params)
+
+async def get_or_load(key: str, loader: Callable[[], Awaitable[Any]], ttl: Optional[float] = None):
+    """Read-through: return the cached value or load, cache and return it (None is not cached)"""
+    value = await cache.get(key)
+    if value is None:
+        value = await loader()
+        if value is not None:
+            await cache.set(key, value, ttl)
+    return value
+
+async def get_or_load_page(key: str, loader: Callable[[], Awaitable[dict]], response: Response) -> list:
+    """Read-through for a keyset page cached as {"items": [...], "next_cursor": ...}"""
+    page = await get_or_load(key, loader)
+    if page["next_cursor"]:
+        response.headers[NEXT_CURSOR_HEADER] = page["next_cursor"]
+    return page["items"]
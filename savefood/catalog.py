@@ -0,0 +1,73 @@
+# catalog.py
+import hashlib
+from typing import Dict, Iterable, Optional, Tuple
+
+from fastapi import Request, Response
+from sqlalchemy import select
+
+from database import upsert
+from models import CatalogVersion
+
+# Conditional GETs for the catalogue. Every write to bags or shops bumps the
+# table's counter in the same transaction, and an ETag hashes the counters a
+# response depends on, so If-None-Match is answered with one primary key
+# read. Read the versions before the data and key cached copies by them:
+# a body is then never older than its tag, and a 304 (tag == current
+# version) is only sent when nothing changed since the body was read.
+#
+# The global counters cover the shape of the catalogue: rows added,
+# edited or removed. A sale only bumps its bag's own version column, so
+# checkouts never write a shared row; bag detail is tagged by that
+# version alone and list pages fold in the versions of the rows they show.
+
+CATALOG_CACHE_CONTROL = "no-cache"  # clients may store responses but must revalidate
+
+def bump_versions(db, *names: str):
+    """(statement, parameter rows) adding one to each named counter; execute before the write commits"""
+    statement = upsert(db, CatalogVersion.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=["name"], set_={"version": CatalogVersion.__table__.c.version + 1}
+    )
+    return statement, [{"name": name, "version": 1} for name in names]
+
+async def get_versions(db, *names: str) -> Dict[str, int]:
+    result = await db.execute(
+        select(CatalogVersion.name, CatalogVersion.version).where(CatalogVersion.name.in_(names))
+    )
+    versions = dict(result.all())
+    return {name: versions.get(name, 0) for name in names}
+
+def row_versions(rows: Iterable[Tuple]) -> int:
+    """One number for the (id, version) of every row a page shows, to add to its versions"""
+    digest = hashlib.blake2b(digest_size=8)
+    for row_id, version in rows:
+        digest.update(f"{row_id}={version};".encode())
+    return int.from_bytes(digest.digest(), "big")
+
+def make_etag(versions: Dict[str, int]) -> str:
+    """Strong ETag for a response built from the tables at these versions"""
+    tag = ";".join(f"{name}={version}" for name, version in sorted(versions.items()))
+    return '"' + hashlib.blake2b(tag.encode(), digest_size=12).hexdigest() + '"'
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """A 304 response if If-None-Match already names etag, else None.
+
+    * never matches: routes call this before they know the bag or shop
+    exists, and a missing id must still get its 404.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    candidates = {candidate.strip().removeprefix("W/") for candidate in header.split(",")}
+    if etag in candidates:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL})
+    return None
+
+def versioned_key(key: str, versions: Dict[str, int]) -> str:
+    """Cache key that moves on with the catalogue, so a cached body is never older than its tag"""
+    return key + "@" + ",".join(str(versions[name]) for name in sorted(versions))
+
+def set_etag(response: Response, etag: str) -> Response:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CATALOG_CACHE_CONTROL
+    return response
@@ -2,11 +2,16 @@
 from celery import Celery
 import os
 
-# Celery configuration
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
+CELERY_PUBLISH_TIMEOUT = float(os.getenv("CELERY_PUBLISH_TIMEOUT", "1"))  # seconds to reach the broker before a publish fails
+
+# Celery configuration. With TASK_BACKEND=local (see dispatch.py) tasks run
+# in process and the broker is never contacted
 celery_app = Celery(
     'surprise_bags',
-    broker='redis://localhost:6379/0',
-    backend='redis://localhost:6379/0',
+    broker=CELERY_BROKER_URL,
+    backend=CELERY_RESULT_BACKEND,
     include=['tasks']
 )
 
@@ -20,13 +25,37 @@ celery_app.conf.update(
     task_track_started=True,
     task_time_limit=3600,  # 1 hour timeout
     task_soft_time_limit=3300,  # 55 minutes soft timeout
+    # Tasks write their outcome to the database; no caller reads a result,
+    # and subscribing to the result backend on every publish retried for
+    # ~20 s when Redis was down
+    task_ignore_result=True,
+    # Fail a publish fast rather than hold the caller while the broker is
+    # down; the catch-up sweep and the beat jobs cover a lost message
+    broker_connection_timeout=CELERY_PUBLISH_TIMEOUT,
+    broker_transport_options={
+        'socket_connect_timeout': CELERY_PUBLISH_TIMEOUT,
+        'socket_timeout': CELERY_PUBLISH_TIMEOUT,
+        'max_retries': 0,
+    },
 )
 
-# Optional: Configure periodic tasks
+# Optional: Configure periodic tasks. Pickup reminders are scheduled per
+# order (tasks.schedule_pickup_reminders); tasks.check_expiring_bags is a
+# manual catch-up and no longer runs here. With TASK_BACKEND=local the
+# dispatcher runs this schedule itself, plus check_expiring_bags (see
+# dispatch.local_schedule).
 celery_app.conf.beat_schedule = {
-    'check-expiring-bags': {
-        'task': 'tasks.check_expiring_bags',
-        'schedule': 3600.0,  # Every hour
+    'purge-notifications': {
+        'task': 'tasks.purge_notifications',
+        'schedule': float(os.getenv("NOTIFICATION_PURGE_INTERVAL_SECONDS", "3600")),
+    },
+    'deactivate-expired-bags': {
+        'task': 'tasks.deactivate_expired_bags',
+        'schedule': float(os.getenv("DEACTIVATE_EXPIRED_BAGS_INTERVAL_SECONDS", "300")),
+    },
+    'materialize-bag-templates': {
+        'task': 'tasks.materialize_bag_templates',
+        'schedule': float(os.getenv("TEMPLATE_MATERIALIZE_INTERVAL_SECONDS", "900")),
     },
 }
 
@@ -1,11 +1,291 @@
 # database.py
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+logger = logging.getLogger(__name__)
+
+# Connection settings, shared by the API and the Celery workers
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./surprise_bags.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds, -1 disables
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))  # seconds
+DB_POOL_WAIT_WARN_MS = float(os.getenv("DB_POOL_WAIT_WARN_MS", "100"))
+
+# SQLite profile: "production" turns on WAL and the pragmas below for file
+# databases and sends all writes through one serialized writer connection;
+# "default" leaves SQLite as it comes.
+DB_SQLITE_PROFILE = os.getenv("DB_SQLITE_PROFILE", "production")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # bytes
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))  # negative means KiB
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", str(DB_CONNECT_TIMEOUT * 1000)))
+
+# Async drivers for the backends we run on
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def to_async_url(url: str) -> str:
+    """Return the async-driver variant of a sync database URL"""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+    return parsed.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+class PoolStats:
+    """Checkout and wait counters for one connection pool"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkins = 0
+            self.connects = 0
+            self.timeouts = 0
+            self.slow_waits = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if seconds * 1000 >= DB_POOL_WAIT_WARN_MS:
+                self.slow_waits += 1
+        if seconds * 1000 >= DB_POOL_WAIT_WARN_MS:
+            logger.warning(f"Waited {seconds * 1000:.0f} ms for a {self.name} database connection")
+
+    def record_checkin(self):
+        with self._lock:
+            self.checkins += 1
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            waits = self.checkouts + self.timeouts
+            return {
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "connects": self.connects,
+                "timeouts": self.timeouts,
+                "slow_waits": self.slow_waits,
+                "wait_avg_ms": (self.wait_total / waits * 1000) if waits else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+
+POOL_STATS = {}
+ENGINES = {}
+
+def _timed_pool_class(pool_class, stats: PoolStats):
+    """Subclass a queue pool so every checkout records how long it waited.
+
+    Pool recreation (engine.dispose()) instantiates the same class, so the
+    stats survive it.
+    """
+    class TimedPool(pool_class):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except PoolTimeoutError:
+                stats.record_wait(time.perf_counter() - start, timed_out=True)
+                raise
+            stats.record_wait(time.perf_counter() - start)
+            return connection
+
+        def _do_return_conn(self, record):
+            stats.record_checkin()
+            super()._do_return_conn(record)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+def _engine_options(url: str, is_async: bool) -> dict:
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    options = {}
+    connect_args = {}
+
+    if backend == "sqlite":
+        # sqlite's timeout is how long a statement waits on a locked database
+        connect_args["timeout"] = DB_CONNECT_TIMEOUT
+        if not is_async:
+            connect_args["check_same_thread"] = False
+        if parsed.database in (None, "", ":memory:"):
+            # In-memory databases live in a single connection; no pool to size
+            options["connect_args"] = connect_args
+            return options
+    elif backend == "postgresql":
+        connect_args["timeout" if is_async else "connect_timeout"] = DB_CONNECT_TIMEOUT
+
+    options.update(
+        connect_args=connect_args,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    return options
+
+def create_db_engine(url: str = DATABASE_URL, name: str = "sync", is_async: bool = False, **overrides):
+    """Create an engine from the DB_* settings, with pool statistics under POOL_STATS[name]"""
+    options = _engine_options(url, is_async)
+    options.update(overrides)
+
+    stats = POOL_STATS[name] = PoolStats(name)
+    if "pool_size" in options and "poolclass" not in options:
+        base_pool = AsyncAdaptedQueuePool if is_async else QueuePool
+        options["poolclass"] = _timed_pool_class(base_pool, stats)
+
+    if is_async:
+        db_engine = create_async_engine(to_async_url(url), **options)
+        event.listen(db_engine.sync_engine, "connect", lambda *args: stats.record_connect())
+    else:
+        db_engine = create_engine(url, **options)
+        event.listen(db_engine, "connect", lambda *args: stats.record_connect())
+    ENGINES[name] = db_engine
+    return db_engine
+
+def pool_stats() -> dict:
+    """Checkout/wait counters plus current pool occupancy for every engine"""
+    report = {}
+    for name, db_engine in ENGINES.items():
+        pool = getattr(db_engine, "sync_engine", db_engine).pool
+        snapshot = POOL_STATS[name].snapshot()
+        if isinstance(pool, QueuePool):
+            snapshot.update(
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+                idle=pool.checkedin(),
+            )
+        report[name] = snapshot
+    return report
+
+def use_sqlite_profile(url: str) -> bool:
+    """True when url is a file-backed SQLite database and the production profile is on"""
+    parsed = make_url(url)
+    return (
+        DB_SQLITE_PROFILE == "production"
+        and parsed.get_backend_name() == "sqlite"
+        and parsed.database not in (None, "", ":memory:")
+    )
+
+def apply_sqlite_pragmas(db_engine, writer: bool = False):
+    """Configure every new SQLite connection of db_engine for concurrent use.
+
+    The writer connection also opens its transactions with BEGIN IMMEDIATE,
+    so it takes the write lock up front instead of failing to upgrade a
+    read lock halfway through.
+    """
+    sync_engine = getattr(db_engine, "sync_engine", db_engine)
+
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+        if writer:
+            # Let the begin hook below issue BEGIN instead of the driver
+            dbapi_connection.isolation_level = None
+
+    if writer:
+        @event.listens_for(sync_engine, "begin")
+        def begin_immediate(connection):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+def create_writer_engine(url: str = DATABASE_URL, name: str = "sync_writer", is_async: bool = False):
+    """A single-connection engine; callers queue on its pool instead of on SQLite's lock"""
+    return create_db_engine(url, name=name, is_async=is_async, pool_size=1, max_overflow=0)
+
+class RoutingSession(Session):
+    """Session that sends writes to the writer engine and reads to the shared pool.
+
+    Once a transaction has written it stays on the writer until it ends,
+    so later reads in the same transaction see its own changes.
+    """
+
+    def __init__(self, *args, reader=None, writer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reader = reader
+        self.writer = writer
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.writer is None:
+            return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["use_writer"] = True
+        if self.info.get("use_writer"):
+            return self.writer
+        return self.reader
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def release_writer(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("use_writer", None)
+
+engine = create_db_engine(DATABASE_URL, name="sync")
+# Async engine used by the API routers so queries do not block the event loop.
+async_engine = create_db_engine(DATABASE_URL, name="async", is_async=True)
+
+if use_sqlite_profile(DATABASE_URL):
+    writer_engine = create_writer_engine(DATABASE_URL)
+    async_writer_engine = create_writer_engine(DATABASE_URL, name="async_writer", is_async=True)
+    for db_engine in (engine, async_engine):
+        apply_sqlite_pragmas(db_engine)
+    for db_engine in (writer_engine, async_writer_engine):
+        apply_sqlite_pragmas(db_engine, writer=True)
+else:
+    writer_engine = engine
+    async_writer_engine = async_engine
+
+SessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, bind=engine,
+    class_=RoutingSession, reader=engine, writer=writer_engine
+)
+
+# expire_on_commit is off because expired attributes cannot be lazily
+# reloaded from async code.
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False,
+    sync_session_class=RoutingSession,
+    reader=async_engine.sync_engine, writer=async_writer_engine.sync_engine
+)
 
-DATABASE_URL = "sqlite:///./surprise_bags.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 def get_db():
@@ -13,4 +293,18 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# INSERT constructs with on_conflict_do_update/do_nothing, per dialect
+UPSERT_INSERTS = {
+    "sqlite": sqlite_insert,
+    "postgresql": pg_insert,
+}
+
+def upsert(session, table):
+    """insert(table) supporting ON CONFLICT for the database the session writes to"""
+    return UPSERT_INSERTS[session.get_bind().dialect.name](table)
@@ -0,0 +1,216 @@
+# dispatch.py
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from celery_config import celery_app
+
+logger = logging.getLogger(__name__)
+
+TASK_BACKEND = os.getenv("TASK_BACKEND", "celery")  # celery or local
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "4"))
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", "1000"))
+DISPATCH_SUBMIT_TIMEOUT = float(os.getenv("DISPATCH_SUBMIT_TIMEOUT", "5"))  # seconds a producer may block on a full queue
+DISPATCH_DRAIN_SECONDS = float(os.getenv("DISPATCH_DRAIN_SECONDS", "30"))
+DISPATCH_BEAT = os.getenv("DISPATCH_BEAT", "true").lower() == "true"  # local backend runs the periodic tasks
+CHECK_EXPIRING_BAGS_INTERVAL_SECONDS = float(os.getenv("CHECK_EXPIRING_BAGS_INTERVAL_SECONDS", "300"))
+
+class DispatchQueueFull(Exception):
+    """The local queue stayed full for DISPATCH_SUBMIT_TIMEOUT seconds"""
+
+class Dispatcher:
+    """Runs Celery tasks from tasks.py, now or at an eta (an aware UTC datetime)"""
+
+    def submit(self, task, *args, eta: Optional[datetime] = None):
+        raise NotImplementedError
+
+    def shutdown(self, timeout: float = DISPATCH_DRAIN_SECONDS):
+        pass
+
+class CeleryDispatcher(Dispatcher):
+    """Publishes to the Celery broker; workers run the task"""
+
+    def submit(self, task, *args, eta=None):
+        # No publish retries: see broker_transport_options in celery_config
+        task.apply_async(args=list(args), eta=eta, retry=False)
+
+class LocalDispatcher(Dispatcher):
+    """Runs tasks on in-process worker threads, for single-node sites and load tests.
+
+    Due tasks wait in a bounded queue: when it is full, submit blocks the
+    producer for up to submit_timeout and then raises DispatchQueueFull.
+    Tasks with an eta wait on a timer heap until due. shutdown stops
+    intake, lets the queue drain and drops timers that are not due yet;
+    tasks are not persisted, so whatever is dropped is logged.
+
+    There is no beat process either, so with beat set the dispatcher runs
+    local_schedule() itself: celery_app.conf.beat_schedule on its
+    intervals, and check_expiring_bags at start and then periodically to
+    send the reminders whose timers a restart dropped.
+    """
+
+    def __init__(
+        self,
+        workers: int = DISPATCH_WORKERS,
+        queue_size: int = DISPATCH_QUEUE_SIZE,
+        submit_timeout: float = DISPATCH_SUBMIT_TIMEOUT,
+        beat: bool = DISPATCH_BEAT,
+    ):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.submit_timeout = submit_timeout
+        self.timers = []
+        self.timer_sequence = itertools.count()
+        self.timer_condition = threading.Condition()
+        self.closed = False
+        self.completed = 0
+        self.failed = 0
+        self.stats_lock = threading.Lock()
+        # Daemon threads: interpreter exit must not wait on them before
+        # the atexit drain runs
+        self.workers = [
+            threading.Thread(target=self._work, name=f"dispatch-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        self.timer_thread = threading.Thread(target=self._run_timers, name="dispatch-timers", daemon=True)
+        for thread in self.workers + [self.timer_thread]:
+            thread.start()
+        atexit.register(self.shutdown)
+        if beat:
+            now = datetime.now(timezone.utc)
+            for name, (interval, run_at_start) in local_schedule().items():
+                first = now if run_at_start else now + timedelta(seconds=interval)
+                self._push_timer(first, name, (), interval)
+
+    def submit(self, task, *args, eta=None):
+        if self.closed:
+            raise RuntimeError("Dispatcher is shut down")
+        if eta is not None and eta > datetime.now(timezone.utc):
+            self._push_timer(eta, task, args)
+            return
+        self._enqueue(task, args, self.submit_timeout)
+
+    def _push_timer(self, eta, task, args, interval: Optional[float] = None):
+        """Wait until eta; with an interval the timer re-arms after each run"""
+        with self.timer_condition:
+            heapq.heappush(self.timers, (eta, next(self.timer_sequence), task, args, interval))
+            self.timer_condition.notify()
+
+    def _enqueue(self, task, args, timeout):
+        try:
+            self.queue.put((task, args), timeout=timeout)
+        except queue.Full:
+            raise DispatchQueueFull(f"Task queue full ({self.queue.maxsize}), rejected {task.name}")
+
+    def _run_timers(self):
+        while True:
+            with self.timer_condition:
+                while not self.closed and (
+                    not self.timers or self.timers[0][0] > datetime.now(timezone.utc)
+                ):
+                    wait = None
+                    if self.timers:
+                        wait = (self.timers[0][0] - datetime.now(timezone.utc)).total_seconds()
+                    self.timer_condition.wait(timeout=wait)
+                if self.closed:
+                    return
+                eta, _, task, args, interval = heapq.heappop(self.timers)
+                if interval is not None:
+                    # From the last due time so runs do not drift, but never
+                    # in the past: a late run is not followed by a burst
+                    heapq.heappush(self.timers, (
+                        max(eta + timedelta(seconds=interval), datetime.now(timezone.utc)),
+                        next(self.timer_sequence), task, args, interval
+                    ))
+            try:
+                if isinstance(task, str):
+                    # Periodic tasks are named as in beat_schedule; tasks.py
+                    # imports this module, so look them up when due
+                    task = celery_app.tasks[task]
+                # Block rather than drop: a due task waits for queue room
+                self._enqueue(task, args, None)
+            except Exception as e:
+                logger.error(f"Error enqueuing scheduled task {getattr(task, 'name', task)}: {str(e)}")
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            task, args = item
+            try:
+                task(*args)
+                with self.stats_lock:
+                    self.completed += 1
+            except Exception as e:
+                with self.stats_lock:
+                    self.failed += 1
+                logger.error(f"Error running task {task.name}: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def shutdown(self, timeout: float = DISPATCH_DRAIN_SECONDS):
+        """Stop accepting tasks and finish the queued ones within timeout seconds"""
+        if self.closed:
+            return
+        self.closed = True
+        with self.timer_condition:
+            dropped = sum(1 for timer in self.timers if timer[4] is None)
+            self.timers.clear()
+            self.timer_condition.notify()
+        if dropped:
+            logger.warning(f"Dropped {dropped} scheduled tasks that were not yet due")
+
+        deadline = time.monotonic() + timeout
+        for _ in self.workers:
+            try:
+                self.queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                break
+        for thread in self.workers:
+            thread.join(timeout=max(deadline - time.monotonic(), 0))
+        if self.queue.unfinished_tasks:
+            logger.warning(f"Shutdown timed out with {self.queue.qsize()} tasks still queued")
+
+    def stats(self) -> dict:
+        with self.timer_condition:
+            scheduled = len(self.timers)
+        return {
+            "queued": self.queue.qsize(),
+            "scheduled": scheduled,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+def local_schedule() -> dict:
+    """Task name -> (interval seconds, run at start) for the local backend's beat"""
+    schedule = {"tasks.check_expiring_bags": (CHECK_EXPIRING_BAGS_INTERVAL_SECONDS, True)}
+    for entry in celery_app.conf.beat_schedule.values():
+        interval = entry["schedule"]
+        if isinstance(interval, timedelta):
+            interval = interval.total_seconds()
+        if not isinstance(interval, (int, float)):
+            logger.warning(f"Local backend cannot run {entry['task']} on schedule {interval}")
+            continue
+        schedule[entry["task"]] = (float(interval), False)
+    return schedule
+
+DISPATCHERS = {
+    "celery": CeleryDispatcher,
+    "local": LocalDispatcher,
+}
+
+def create_dispatcher(backend: str = TASK_BACKEND) -> Dispatcher:
+    if backend not in DISPATCHERS:
+        raise ValueError(f"Unknown TASK_BACKEND: {backend}")
+    logger.info(f"Dispatching tasks with the {backend} backend")
+    return DISPATCHERS[backend]()
+
+dispatcher = create_dispatcher()
@@ -9,7 +9,7 @@ async function fetchBags(maxRetries = 3) {
   let attempts = 0;
   while (attempts < maxRetries) {
     try {
-      const response = await fetch("/bags/", {
+      const response = await fetch("/bags/?expand=business", {
         method: "GET",
         headers: {
           "Content-Type": "application/json",
@@ -37,6 +37,7 @@ async function fetchBags(maxRetries = 3) {
                       bag.image_urls?.[0] || "/images/placeholder.jpg"
                     }" alt="${bag.title}">
                     <h3>${bag.title}</h3>
+                    <p class="shop">${bag.business?.name || ""}</p>
                     <p>${bag.description || "No description available"}</p>
                     <p class="price">$${bag.discount_price.toFixed(
                       2
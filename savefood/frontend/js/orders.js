@@ -8,7 +8,7 @@ document.addEventListener("DOMContentLoaded", () => {
         throw new Error("Please log in to view your orders.");
       }
 
-      const response = await fetch("http://127.0.0.1:8000/orders", {
+      const response = await fetch("http://127.0.0.1:8000/orders?expand=bag.business", {
         headers: {
           Authorization: `Bearer ${token}`,
         },
@@ -34,7 +34,8 @@ document.addEventListener("DOMContentLoaded", () => {
       orderCard.className = "order-card";
       orderCard.innerHTML = `
                 <h3>Order #${order.id}</h3>
-                <p>Bag: ${order.bag_id}</p>
+                <p>Bag: ${order.bag ? order.bag.title : order.bag_id}</p>
+                <p>Shop: ${order.bag?.business?.name || "Unknown"}</p>
                 <p>Total: $${order.total_price}</p>
                 <p class="status">Status: ${order.status}</p>
             `;
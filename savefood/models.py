@@ -1,14 +1,14 @@
 # models.py
 import enum
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import List
 from sqlalchemy.dialects.postgresql import UUID, ARRAY
 from sqlalchemy import Column, Integer, String, Float, ForeignKey
 
 from sqlalchemy import (
-    Column, Integer, String, Text, Boolean, DateTime, 
-    Numeric, JSON, ForeignKey, Enum as SQLEnum, Index
+    Column, Integer, String, Text, Boolean, DateTime, Date, Time,
+    Numeric, JSON, ForeignKey, Enum as SQLEnum, Index, DDL, event
 )
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
@@ -16,6 +16,10 @@ from sqlalchemy.sql import func
 
 from database import Base
 
+def utcnow():
+    """Naive UTC timestamp, the same representation func.now() stores"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 # Enums
 class UserRole(str, enum.Enum):
     customer = "customer"
@@ -57,6 +61,7 @@ class Business(Base):
     __tablename__ = "businesses"
     __table_args__ = (
         Index('ix_business_name', 'name'),
+        Index('ix_business_created', 'created_at', 'id'),
     )
     is_approved = Column(Boolean, default=False)
     
@@ -65,17 +70,21 @@ class Business(Base):
     description = Column(Text)
     address = Column(String(255))
     logo_url = Column(String(255))
-    created_at = Column(DateTime, server_default=func.now())
+    created_at = Column(DateTime, default=utcnow, server_default=func.now())
     
     # Relationships
     user = relationship("User", back_populates="business")
     bags = relationship("SurpriseBag", back_populates="business", cascade="all, delete-orphan")
+    bag_templates = relationship("BagTemplate", back_populates="business", cascade="all, delete-orphan")
 
 class SurpriseBag(Base):
     __tablename__ = "surprise_bags"
     __table_args__ = (
         Index('ix_surprise_bag_business', 'business_id'),
-        Index('ix_surprise_bag_active', 'is_active'),
+        Index('ix_surprise_bag_active_pickup', 'is_active', 'pickup_end', 'id'),
+        Index('ix_surprise_bag_created', 'created_at', 'id'),
+        # One bag per template and day: makes materializing templates idempotent
+        Index('ux_surprise_bag_template_date', 'template_id', 'template_date', unique=True),
     )
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -90,30 +99,98 @@ class SurpriseBag(Base):
     pickup_end = Column(DateTime, nullable=False)
     image_urls = Column(JSON)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, server_default=func.now())
+    created_at = Column(DateTime, default=utcnow, server_default=func.now())
+    template_id = Column(UUID(as_uuid=True), ForeignKey('bag_templates.id', ondelete='SET NULL'))
+    template_date = Column(Date)
+    # Bumped by every write to the row, sales included; keys the bag's
+    # cache entry and ETag so a sale invalidates only this bag
+    version = Column(Integer, nullable=False, default=1, server_default="1")
     
     # Relationships
     business = relationship("Business", back_populates="bags")
     orders = relationship("Order", back_populates="bag", cascade="all, delete-orphan")
 
+class BagTemplate(Base):
+    """A bag a shop posts on a weekly schedule; tasks.materialize_bag_templates creates the SurpriseBags.
+
+    Pickup times are UTC times of day, like every stored timestamp; an end
+    time at or before the start means the window runs past midnight.
+    """
+    __tablename__ = "bag_templates"
+    __table_args__ = (
+        Index('ix_bag_template_business', 'business_id'),
+        Index('ix_bag_template_active', 'is_active'),
+    )
+    
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    business_id = Column(UUID(as_uuid=True), ForeignKey('businesses.id', ondelete='CASCADE'), nullable=False)
+    title = Column(String(100), nullable=False)
+    description = Column(Text)
+    original_price = Column(Numeric(10, 2), nullable=False)
+    discount_price = Column(Numeric(10, 2), nullable=False)
+    quantity_available = Column(Integer, nullable=False)
+    pickup_start_time = Column(Time, nullable=False)
+    pickup_end_time = Column(Time, nullable=False)
+    weekdays = Column(Integer, nullable=False, default=0b1111111)  # bit 0 is Monday, as in date.weekday()
+    starts_on = Column(Date)
+    ends_on = Column(Date)
+    image_urls = Column(JSON)
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=utcnow, server_default=func.now())
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
+    
+    business = relationship("Business", back_populates="bag_templates")
+
+    def runs_on(self, day) -> bool:
+        return bool(self.weekdays & (1 << day.weekday())) and \
+            (self.starts_on is None or day >= self.starts_on) and \
+            (self.ends_on is None or day <= self.ends_on)
+
+# Search index over bag title, description and recommended tags, kept in
+# sync by search.py. SQLite uses an FTS5 table, Postgres a tsvector table.
+event.listen(SurpriseBag.__table__, "after_create", DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS surprise_bags_fts USING fts5("
+    "bag_id UNINDEXED, title, description, tags, tokenize='porter unicode61')"
+).execute_if(dialect="sqlite"))
+event.listen(SurpriseBag.__table__, "before_drop", DDL(
+    "DROP TABLE IF EXISTS surprise_bags_fts"
+).execute_if(dialect="sqlite"))
+event.listen(SurpriseBag.__table__, "after_create", DDL(
+    "CREATE TABLE IF NOT EXISTS surprise_bags_search ("
+    "bag_id UUID PRIMARY KEY REFERENCES surprise_bags (id) ON DELETE CASCADE, "
+    "document TSVECTOR NOT NULL); "
+    "CREATE INDEX IF NOT EXISTS ix_surprise_bags_search_document "
+    "ON surprise_bags_search USING GIN (document)"
+).execute_if(dialect="postgresql"))
+event.listen(SurpriseBag.__table__, "before_drop", DDL(
+    "DROP TABLE IF EXISTS surprise_bags_search"
+).execute_if(dialect="postgresql"))
+
 class Order(Base):
     __tablename__ = "orders"
     __table_args__ = (
         Index('ix_order_customer', 'customer_id','bag_id', 'created_at', unique=True),
         Index('ix_order_status', 'status'),
+        Index('ix_order_customer_created', 'customer_id', 'created_at', 'id'),
+        Index('ix_order_bag_created', 'bag_id', 'created_at', 'id'),
+        Index('ix_order_business_created', 'business_id', 'created_at', 'id'),
+        Index('ix_order_business_reviewed', 'business_id', 'reviewed_at', 'id'),
     )
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     customer_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete='SET NULL'))
     bag_id = Column(UUID(as_uuid=True), ForeignKey('surprise_bags.id', ondelete='RESTRICT'), nullable=False)
+    business_id = Column(UUID(as_uuid=True), ForeignKey('businesses.id', ondelete='SET NULL'))  # the bag's, copied so shop queries skip the join
     quantity = Column(Integer, nullable=False)
     total_price = Column(Numeric(10, 2), nullable=False)
     status = Column(SQLEnum(OrderStatus), default=OrderStatus.pending)
     pickup_code = Column(String(20), unique=True)
     rating = Column(Integer)
     feedback = Column(Text)
-    created_at = Column(DateTime, server_default=func.now())
+    created_at = Column(DateTime, default=utcnow, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+    reminder_sent_at = Column(DateTime, nullable=True)  # claimed by the pickup reminder, at most once
+    reviewed_at = Column(DateTime, nullable=True)
     
     # Relationships
     customer = relationship("User", back_populates="orders")
@@ -123,8 +200,9 @@ class Order(Base):
 class Notification(Base):
     __tablename__ = "notifications"
     __table_args__ = (
-        Index('ix_notification_user', 'user_id'),
-        Index('ix_notification_read', 'is_read'),
+        Index('ix_notification_user_created', 'user_id', 'created_at', 'id'),
+        Index('ix_notification_user_unread', 'user_id', 'is_read', 'created_at'),
+        Index('ix_notification_read_created', 'is_read', 'created_at'),  # retention purge range
     )
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -134,9 +212,62 @@ class Notification(Base):
     title = Column(String(100), nullable=False)
     message = Column(Text, nullable=False)
     is_read = Column(Boolean, default=False)
-    created_at = Column(DateTime, server_default=func.now())
+    created_at = Column(DateTime, default=utcnow, server_default=func.now())
     
     # Relationships
     user = relationship("User", back_populates="notifications")
     order = relationship("Order", back_populates="notifications")
 
+class BusinessRating(Base):
+    """Running review totals per business, kept in step by create_review"""
+    __tablename__ = "business_ratings"
+    
+    business_id = Column(UUID(as_uuid=True), ForeignKey('businesses.id', ondelete='CASCADE'), primary_key=True)
+    rating_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    rating_1 = Column(Integer, nullable=False, default=0)
+    rating_2 = Column(Integer, nullable=False, default=0)
+    rating_3 = Column(Integer, nullable=False, default=0)
+    rating_4 = Column(Integer, nullable=False, default=0)
+    rating_5 = Column(Integer, nullable=False, default=0)
+
+class BusinessDailySales(Base):
+    """Per bag, per UTC day order outcomes, kept in step by the order transitions"""
+    __tablename__ = "business_daily_sales"
+    __table_args__ = (
+        Index('ix_business_daily_sales_day', 'business_id', 'day'),
+    )
+    
+    business_id = Column(UUID(as_uuid=True), ForeignKey('businesses.id', ondelete='CASCADE'), primary_key=True)
+    bag_id = Column(UUID(as_uuid=True), primary_key=True)  # no FK: sales history outlives the bag
+    day = Column(Date, primary_key=True)
+    confirmed_orders = Column(Integer, nullable=False, default=0)
+    completed_orders = Column(Integer, nullable=False, default=0)
+    cancelled_orders = Column(Integer, nullable=False, default=0)
+    units_sold = Column(Integer, nullable=False, default=0)
+    revenue = Column(Numeric(12, 2), nullable=False, default=0)
+
+class NotificationArchive(Base):
+    """Read notifications moved out of notifications by the retention job"""
+    __tablename__ = "notifications_archive"
+    __table_args__ = (
+        Index('ix_notification_archive_user_created', 'user_id', 'created_at'),
+    )
+    
+    id = Column(UUID(as_uuid=True), primary_key=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    order_id = Column(UUID(as_uuid=True))  # orders may be gone by the time history is read
+    type = Column(SQLEnum(NotificationType), nullable=False)
+    title = Column(String(100), nullable=False)
+    message = Column(Text, nullable=False)
+    is_read = Column(Boolean, default=True)
+    created_at = Column(DateTime, nullable=False)
+    archived_at = Column(DateTime, default=utcnow, nullable=False)
+
+
+class CatalogVersion(Base):
+    """Change counter per catalogue table, bumped in the writing transaction; ETags derive from it"""
+    __tablename__ = "catalog_versions"
+    
+    name = Column(String(50), primary_key=True)  # "bag" or "shop"
+    version = Column(Integer, nullable=False, default=0)
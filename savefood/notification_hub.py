@@ -0,0 +1,168 @@
+# notification_hub.py
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_HUB_BACKEND = os.getenv("NOTIFICATION_HUB_BACKEND", "memory")  # memory or redis
+NOTIFICATION_HUB_URL = os.getenv("NOTIFICATION_HUB_URL", "redis://localhost:6379/2")
+NOTIFICATION_HUB_CHANNEL = os.getenv("NOTIFICATION_HUB_CHANNEL", "savefood:notifications")
+NOTIFICATION_BUFFER_SIZE = int(os.getenv("NOTIFICATION_BUFFER_SIZE", "100"))  # events per connection
+
+class Subscription:
+    """One connection's buffer of pending events.
+
+    The buffer is bounded: when a slow client lets it fill up, the oldest
+    event is dropped and counted, and the client is told to resync.
+    """
+
+    def __init__(self, user_id: str, buffer_size: int = NOTIFICATION_BUFFER_SIZE):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def push(self, event: dict):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self) -> dict:
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            logger.warning(f"Dropped {dropped} events for slow subscriber {self.user_id}")
+            return {"event": "resync", "dropped": dropped}
+        return await self.queue.get()
+
+class NotificationHub:
+    """Fans events out to every open connection of a user in this process.
+
+    publish may be awaited from request handlers; publish_threadsafe is for
+    task code running on other threads. Subclasses carry events between
+    worker processes.
+    """
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.loop = None
+
+    @asynccontextmanager
+    async def subscribe(self, user_id):
+        self.loop = asyncio.get_running_loop()
+        await self.start()
+        subscription = Subscription(str(user_id))
+        self.subscriptions[subscription.user_id].add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscribers = self.subscriptions[subscription.user_id]
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscriptions[subscription.user_id]
+
+    async def start(self):
+        pass
+
+    def deliver(self, user_id: str, event: dict):
+        for subscription in self.subscriptions.get(user_id, ()):
+            subscription.push(event)
+
+    async def publish(self, user_id, event: dict):
+        self.deliver(str(user_id), event)
+
+    def publish_threadsafe(self, user_id, event: dict):
+        self.publish_many_threadsafe([(user_id, event)])
+
+    def publish_many_threadsafe(self, events):
+        """Publish (user_id, event) pairs from a thread other than the event loop's"""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return  # nobody has subscribed in this process
+        for user_id, event in events:
+            loop.call_soon_threadsafe(self.deliver, str(user_id), event)
+
+class RedisNotificationHub(NotificationHub):
+    """Publishes through a Redis channel that every API worker listens on"""
+
+    def __init__(self, url: str = NOTIFICATION_HUB_URL, channel: str = NOTIFICATION_HUB_CHANNEL):
+        super().__init__()
+        import redis
+        import redis.asyncio as redis_async
+        self.channel = channel
+        self.client = redis_async.Redis.from_url(url)
+        self.sync_client = redis.Redis.from_url(url)
+        self.listener = None
+
+    async def start(self):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self.listen())
+
+    async def listen(self):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.channel)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                payload = json.loads(message["data"])
+                self.deliver(payload["user_id"], payload["event"])
+        except Exception as e:
+            logger.error(f"Notification hub listener stopped: {str(e)}")
+        finally:
+            await pubsub.aclose()
+
+    def encode(self, user_id, event: dict) -> str:
+        return json.dumps({"user_id": str(user_id), "event": event})
+
+    # Push is best effort: clients resync from GET /notifications, so a
+    # Redis outage must not fail the write that triggered the event
+    async def publish(self, user_id, event):
+        try:
+            await self.client.publish(self.channel, self.encode(user_id, event))
+        except Exception as e:
+            logger.error(f"Error publishing notification event: {str(e)}")
+
+    def publish_many_threadsafe(self, events):
+        try:
+            pipeline = self.sync_client.pipeline(transaction=False)
+            for user_id, event in events:
+                pipeline.publish(self.channel, self.encode(user_id, event))
+            pipeline.execute()
+        except Exception as e:
+            logger.error(f"Error publishing notification events: {str(e)}")
+
+NOTIFICATION_HUBS = {
+    "memory": NotificationHub,
+    "redis": RedisNotificationHub,
+}
+
+def create_hub(backend: str = NOTIFICATION_HUB_BACKEND) -> NotificationHub:
+    if backend not in NOTIFICATION_HUBS:
+        raise ValueError(f"Unknown NOTIFICATION_HUB_BACKEND: {backend}")
+    logger.info(f"Using {backend} notification hub")
+    return NOTIFICATION_HUBS[backend]()
+
+notification_hub = create_hub()
+
+def notification_event(type, title, message, order_id=None, id=None, **columns) -> dict:
+    """Push payload for a stored notification; takes Notification's columns as keywords"""
+    return {
+        "event": "notification",
+        "id": str(id) if id else None,
+        "type": getattr(type, "value", type),
+        "title": title,
+        "message": message,
+        "order_id": str(order_id) if order_id else None,
+    }
+
+def order_event(order) -> dict:
+    return {
+        "event": "order_status",
+        "order_id": str(order.id),
+        "bag_id": str(order.bag_id),
+        "status": getattr(order.status, "value", order.status),
+    }
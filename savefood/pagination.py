@@ -0,0 +1,66 @@
+# pagination.py
+import base64
+import binascii
+import json
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import HTTPException, Response, status
+from sqlalchemy import and_, or_
+
+# Lists return their items as before; the cursor for the next page, if any,
+# travels in this header.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(created_at: datetime, row_id: uuid.UUID) -> str:
+    """Opaque cursor pointing just past the row (created_at, row_id)"""
+    payload = json.dumps([created_at.isoformat(), str(row_id)])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    """Return (created_at, id) from a cursor made by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        created_at = datetime.fromisoformat(created_at)
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+        return created_at, uuid.UUID(row_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+def keyset_page(query, created_column, id_column, cursor: Optional[str], limit: int, ascending: bool = False):
+    """Restrict a select to the page after cursor, newest first (or oldest first if ascending).
+
+    Fetches one row more than limit so the caller can tell whether another
+    page exists; pass the rows to finish_page.
+    """
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        if ascending:
+            query = query.where(or_(
+                created_column > created_at,
+                and_(created_column == created_at, id_column > row_id)
+            ))
+        else:
+            query = query.where(or_(
+                created_column < created_at,
+                and_(created_column == created_at, id_column < row_id)
+            ))
+    if ascending:
+        return query.order_by(created_column.asc(), id_column.asc()).limit(limit + 1)
+    return query.order_by(created_column.desc(), id_column.desc()).limit(limit + 1)
+
+def finish_page(rows, limit: int, response: Response, key=lambda row: (row.created_at, row.id)):
+    """Trim the look-ahead row and advertise the next cursor on the response"""
+    rows = list(rows)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(*key(rows[-1]))
+    return rows
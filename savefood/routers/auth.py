@@ -1,15 +1,21 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 from jose import JWTError, jwt
 from models import User, UserRole
 from schemas import Token, UserCreate, TokenData
-from database import get_db
+from database import get_async_db
+from cache import MemoryCache
 from passlib.context import CryptContext
 import os
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import APIRouter, Depends, HTTPException
 from models import User, UserRole
 import uuid
@@ -21,16 +27,77 @@ router = APIRouter(tags=["Authentication"])
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "4"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))  # running plus queued
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes below BCRYPT_ROUNDS count as outdated and are rehashed on the next login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+# Resolved users by token subject (email). Per process: a change made by
+# another worker is picked up when the entry's TTL runs out.
+user_cache = MemoryCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL_SECONDS)
+USER_COLUMNS = [attr.key for attr in inspect(User).column_attrs]
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordHasher:
+    """Runs bcrypt off the event loop on a fixed set of threads.
+
+    bcrypt releases the GIL, so the threads hash in parallel. When
+    max_pending calls are already running or queued, new ones are refused
+    with a 503 at once instead of piling up behind a login storm.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def _release(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    async def run(self, fn, *args):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                logger.warning(f"Password hashing saturated: {self.pending} pending")
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many sign-in attempts in progress, try again shortly",
+                    headers={"Retry-After": "1"},
+                )
+            self.pending += 1
+        # The slot is held until the hash itself finishes, even if the
+        # request gives up waiting
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+password_hasher = PasswordHasher()
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.run(get_password_hash, password)
+
+async def verify_and_update_password(password: str, hashed_password: str):
+    """Return (verified, new_hash); new_hash is set when the stored hash is outdated"""
+    return await password_hasher.run(pwd_context.verify_and_update, password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -50,17 +117,18 @@ async def get_current_business_owner():
         role=UserRole.BUSINESS
     )
 
-@router.post("/login")
-async def login():
-    # Mock login response for testing
-    return {"access_token": "mock_token", "token_type": "bearer"}
-async def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
 
 async def get_current_user(
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
+    return await get_user_from_token(token, db)
+
+async def get_user_from_token(token: str, db: AsyncSession):
+    """Resolve a bearer token to its user, raising 401 if it is invalid"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -74,11 +142,28 @@ async def get_current_user(
         token_data = TokenData(email=email)
     except JWTError:
         raise credentials_exception
-    user = await get_user_by_email(db, email=token_data.email)
+    user = await get_cached_user(db, email=token_data.email)
     if user is None:
         raise credentials_exception
     return user
 
+async def get_cached_user(db: AsyncSession, email: str):
+    """get_user_by_email served from user_cache; the user comes back attached to db"""
+    columns = await user_cache.get(email)
+    if columns is None:
+        user = await get_user_by_email(db, email=email)
+        if user is not None:
+            await user_cache.set(email, {key: getattr(user, key) for key in USER_COLUMNS})
+        return user
+    # Rebuild a fresh instance per request and attach it without a SELECT;
+    # changes made to it flush as a normal UPDATE
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return await db.merge(user, load=False)
+
+async def invalidate_user(email: str):
+    await user_cache.delete(email)
+
 async def get_current_customer(
     current_user: User = Depends(get_current_user)
 ):
@@ -110,7 +195,7 @@ async def get_current_admin(
     return current_user
 
 @router.post("/register", status_code=status.HTTP_201_CREATED)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)):
     logger.info(f"Registering user with email: {user_data.email}")
     db_user = await get_user_by_email(db, user_data.email)
     if db_user:
@@ -125,7 +210,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Password must be at least 8 characters"
         )
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await hash_password(user_data.password)
     new_user = User(
         email=user_data.email,
         password_hash=hashed_password,
@@ -134,13 +219,13 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         role=user_data.role,
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     logger.info(f"User registered successfully: {user_data.email}")
     return {"message": "User registered successfully"}
 
 @router.post("/login", response_model=Token)
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db)):
+async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_async_db)):
     logger.info(f"Login attempt for email: {form_data.username}")
     user = await get_user_by_email(db, form_data.username)
     if not user:
@@ -150,13 +235,19 @@ async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db:
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    if not verify_password(form_data.password, user.password_hash):
+    verified, new_hash = await verify_and_update_password(form_data.password, user.password_hash)
+    if not verified:
         logger.error(f"Invalid password for: {form_data.username}")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        logger.info(f"Rehashing outdated password for: {form_data.username}")
+        user.password_hash = new_hash
+        await db.commit()
+        await invalidate_user(user.email)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.email}, expires_delta=access_token_expires
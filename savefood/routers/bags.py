@@ -1,22 +1,62 @@
 # routers/bags.py
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, Query, Request, Response, UploadFile
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional, Tuple
+from contextlib import asynccontextmanager
+import asyncio
+import logging
 import uuid
 
-from database import get_db
-from models import SurpriseBag, User, Business
-from schemas import SurpriseBagCreate, SurpriseBagOut, SurpriseBagUpdate
+from database import get_async_db
+from models import SurpriseBag, BagTemplate, User, Business, Order, OrderStatus, utcnow
+from schemas import SurpriseBagCreate, SurpriseBagOut, SurpriseBagUpdate, TagRecommendation, BagImportOut
+from schemas import SurpriseBagExpandedOut, ShopOut
+from schemas import BagTemplateCreate, BagTemplateOut, BagTemplateUpdate
 from routers.auth import get_current_business_owner
+from pagination import keyset_page, finish_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from search import get_search_backend, tokenize
+from tagging import tag_recommender
+from pagination import NEXT_CURSOR_HEADER
+from cache import entity_key, list_key, get_or_load
+from catalog import bump_versions, get_versions, make_etag, not_modified, row_versions, set_etag, versioned_key
+from serialization import columns, dump_rows, dumps, json_response, parse_expand
+from routers.shops import get_cached_shop
+from tasks import schedule_pickup_reminders, schedule_template_materialization
+from bag_import import IMPORT_FORMATS, IMPORT_MAX_ERRORS, detect_format, read_records, validate_chunk
 
-router = APIRouter(tags=["Bags"])
+@asynccontextmanager
+async def lifespan(app):
+    # Merged into the app's lifespan by include_router, so tags are scored
+    # against every existing bag from the first request
+    await tag_recommender.startup()
+    yield
+
+router = APIRouter(tags=["Bags"], lifespan=lifespan)
+logger = logging.getLogger(__name__)
+
+MAX_TAG_BATCH = 1000
+BAG_EXPANSIONS = ("business",)
+
+def bag_loader_options(expand_paths, parent=None) -> list:
+    """Eager loads for a bag's expansions; parent is the loader option reaching the bag, if any"""
+    if "business" not in expand_paths:
+        return []
+    if parent is None:
+        return [selectinload(SurpriseBag.business)]
+    return [parent.selectinload(SurpriseBag.business)]
+
+def bag_out(bag: SurpriseBag, expand_paths) -> dict:
+    """SurpriseBagOut as a dict, plus the expansions, which must have been eager loaded"""
+    data = SurpriseBagOut.model_validate(bag).model_dump(mode="json")
+    if "business" in expand_paths:
+        data["business"] = ShopOut.model_validate(bag.business).model_dump(mode="json")
+    return data
 
 def recommend_tags(title: str, description: str) -> List[str]:
     """Generate tag recommendations based on title and description."""
-    common_words = {"the", "and", "of", "to", "a", "in", "for", "with"}
-    title_words = set(title.lower().split()) - common_words
-    desc_words = set(description.lower().split()) - common_words
-    return list(title_words.union(desc_words))[:5]
+    return tag_recommender.recommend([(title, description)])[0]
 
 @router.post("/tags/recommend", response_model=List[str])
 async def recommend_bag_tags(bag: SurpriseBagCreate):
@@ -24,18 +64,31 @@ async def recommend_bag_tags(bag: SurpriseBagCreate):
     tags = recommend_tags(bag.title, bag.description)
     return tags
 
+@router.post("/tags/recommend/batch", response_model=List[List[str]])
+async def recommend_bag_tags_batch(bags: List[TagRecommendation]):
+    """Recommend tags for many title/description pairs in one call, in request order."""
+    if len(bags) > MAX_TAG_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_TAG_BATCH} bags per batch")
+    return tag_recommender.recommend([(bag.title, bag.description) for bag in bags])
+
+async def get_approved_business(db: AsyncSession, current_user: User) -> Business:
+    """The owner's business, which must be approved before it can post bags"""
+    result = await db.execute(select(Business).where(Business.id == current_user.id))
+    business = result.scalars().first()
+    if not business:
+        raise HTTPException(status_code=404, detail="Business not found for this user")
+    if not business.is_approved:
+        raise HTTPException(status_code=403, detail="Business must be approved to create bags")
+    return business
+
 @router.post("/", response_model=SurpriseBagOut, status_code=201)
 async def create_bag(
     bag: SurpriseBagCreate,
     current_user: User = Depends(get_current_business_owner),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Create a new surprise bag"""
-    business = db.query(Business).filter(Business.id == current_user.id).first()
-    if not business:
-        raise HTTPException(status_code=404, detail="Business not found for this user")
-    if not business.is_approved:
-        raise HTTPException(status_code=403, detail="Business must be approved to create bags")
+    business = await get_approved_business(db, current_user)
 
     db_bag = SurpriseBag(
         business_id=business.id,
@@ -50,69 +103,337 @@ async def create_bag(
     )
 
     db.add(db_bag)
-    db.commit()
-    db.refresh(db_bag)
+    await db.flush()
+    await get_search_backend(db).index_bag(db, db_bag, recommend_tags(db_bag.title, db_bag.description))
+    await db.execute(*bump_versions(db, "bag"))
+    await db.commit()
+    await db.refresh(db_bag)
     return db_bag
 
+async def insert_bags(db: AsyncSession, business_id: uuid.UUID, bags: List[tuple]) -> Tuple[int, List[dict]]:
+    """Insert validated (row number, bag) pairs and index them in one transaction.
+
+    If the chunk fails, fall back to one transaction per row so a single
+    bad row only rejects itself; returns the inserted count and errors.
+    """
+    created_at = utcnow()
+    rows = [
+        SurpriseBag(
+            id=uuid.uuid4(), business_id=business_id, created_at=created_at,
+            is_active=True, quantity_sold=0, version=1, **bag.model_dump()
+        )
+        for _, bag in bags
+    ]
+    tags = tag_recommender.recommend([(row.title, row.description) for row in rows])
+
+    async def write(chunk_rows, chunk_tags):
+        await db.execute(insert(SurpriseBag), [
+            {column.key: getattr(row, column.key) for column in SurpriseBag.__table__.columns}
+            for row in chunk_rows
+        ])
+        await get_search_backend(db).index_new_bags(db, chunk_rows, chunk_tags)
+        await db.execute(*bump_versions(db, "bag"))
+        await db.commit()
+
+    try:
+        await write(rows, tags)
+        return len(rows), []
+    except Exception as e:
+        await db.rollback()
+        logger.warning(f"Bag import chunk failed, retrying row by row: {str(e)}")
+
+    inserted, errors = 0, []
+    for (number, _), row, row_tags in zip(bags, rows, tags):
+        try:
+            await write([row], [row_tags])
+            inserted += 1
+        except Exception as e:
+            await db.rollback()
+            errors.append({"row": number, "errors": [str(e)]})
+    return inserted, errors
+
+@router.post("/import", response_model=BagImportOut)
+async def import_bags(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern=f"^({'|'.join(IMPORT_FORMATS)})$"),
+    current_user: User = Depends(get_current_business_owner),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Create bags from a CSV or NDJSON upload, streamed and committed in chunks.
+
+    Valid rows are kept even when others fail; the report lists rejected
+    rows by their 1-based row number. CSV columns are SurpriseBagCreate's
+    fields, with image_urls separated by "|".
+    """
+    business = await get_approved_business(db, current_user)
+    business_id = business.id
+
+    records = read_records(file.file, format or detect_format(file.filename, file.content_type))
+    inserted, failed, errors = 0, 0, []
+    while True:
+        consumed, bags, chunk_errors = await asyncio.to_thread(validate_chunk, records)
+        if not consumed:
+            break
+        if bags:
+            chunk_inserted, insert_errors = await insert_bags(db, business_id, bags)
+            inserted += chunk_inserted
+            chunk_errors = sorted(chunk_errors + insert_errors, key=lambda error: error["row"])
+        failed += len(chunk_errors)
+        errors.extend(chunk_errors[:IMPORT_MAX_ERRORS - len(errors)])
+
+    logger.info(f"Imported {inserted} bags for business {business_id}, {failed} rows rejected")
+    return {"inserted": inserted, "failed": failed, "errors": errors}
+
+@router.get("/search", response_model=List[SurpriseBagOut])
+async def search_bags(
+    q: Optional[str] = None,
+    tags: List[str] = Query([]),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Search active bags by title, description and tags, best match first"""
+    tag_terms = [term for tag in tags for term in tokenize(tag)]
+    if not tokenize(q) and not tag_terms:
+        raise HTTPException(status_code=400, detail="Provide a search query or at least one tag")
+
+    bag_ids = await get_search_backend(db).search(db, q or "", tag_terms, skip, limit)
+    if not bag_ids:
+        return []
+    result = await db.execute(select(SurpriseBag).where(SurpriseBag.id.in_(bag_ids)))
+    bags = {bag.id: bag for bag in result.scalars()}
+    return [bags[bag_id] for bag_id in bag_ids if bag_id in bags]
+
+@router.get("/available", response_model=List[SurpriseBagOut])
+async def list_available_bags(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Bags that can still be ordered: active, in stock and not past pickup, closing soonest first"""
+    query = select(SurpriseBag).where(
+        SurpriseBag.is_active == True,
+        SurpriseBag.pickup_end > utcnow(),
+        SurpriseBag.quantity_available > 0
+    )
+    query = keyset_page(query, SurpriseBag.pickup_end, SurpriseBag.id, cursor, limit, ascending=True)
+    result = await db.execute(query)
+    return finish_page(result.scalars().all(), limit, response, key=lambda bag: (bag.pickup_end, bag.id))
+
+@router.post("/templates", response_model=BagTemplateOut, status_code=201)
+async def create_bag_template(
+    template: BagTemplateCreate,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_business_owner),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Create a recurring bag; the scheduler posts it on every day it runs"""
+    business = await get_approved_business(db, current_user)
+    db_template = BagTemplate(business_id=business.id, **template.model_dump())
+    db.add(db_template)
+    await db.commit()
+    await db.refresh(db_template)
+    # Post today's bag now rather than at the next scheduled run; the
+    # template is committed, so a dispatch failure is logged, not raised,
+    # and the publish happens after the response
+    background_tasks.add_task(schedule_template_materialization)
+    return db_template
+
+@router.get("/templates", response_model=List[BagTemplateOut])
+async def list_bag_templates(
+    current_user: User = Depends(get_current_business_owner),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """List the owner's bag templates"""
+    result = await db.execute(
+        select(BagTemplate)
+        .where(BagTemplate.business_id == current_user.id)
+        .order_by(BagTemplate.created_at)
+    )
+    return result.scalars().all()
+
+@router.put("/templates/{template_id}", response_model=BagTemplateOut)
+async def update_bag_template(
+    template_id: uuid.UUID,
+    template_update: BagTemplateUpdate,
+    current_user: User = Depends(get_current_business_owner),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Update a bag template; bags already posted from it keep their values"""
+    result = await db.execute(select(BagTemplate).where(
+        BagTemplate.id == template_id,
+        BagTemplate.business_id == current_user.id
+    ))
+    db_template = result.scalars().first()
+    if not db_template:
+        raise HTTPException(status_code=404, detail="Template not found or not owned by user")
+
+    for field, value in template_update.model_dump(exclude_unset=True).items():
+        setattr(db_template, field, value)
+    await db.commit()
+    await db.refresh(db_template)
+    return db_template
+
+@router.delete("/templates/{template_id}", status_code=204)
+async def delete_bag_template(
+    template_id: uuid.UUID,
+    current_user: User = Depends(get_current_business_owner),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Delete a bag template; bags already posted from it stay"""
+    result = await db.execute(select(BagTemplate).where(
+        BagTemplate.id == template_id,
+        BagTemplate.business_id == current_user.id
+    ))
+    db_template = result.scalars().first()
+    if not db_template:
+        raise HTTPException(status_code=404, detail="Template not found or not owned by user")
+    await db.delete(db_template)
+    await db.commit()
+    return None
+
 @router.put("/{bag_id}", response_model=SurpriseBagOut)
 async def update_bag(
     bag_id: uuid.UUID,
     bag_update: SurpriseBagUpdate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_business_owner),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Update an existing surprise bag"""
-    db_bag = db.query(SurpriseBag).filter(
+    result = await db.execute(select(SurpriseBag).where(
         SurpriseBag.id == bag_id,
         SurpriseBag.business_id == current_user.id
-    ).first()
+    ))
+    db_bag = result.scalars().first()
     
     if not db_bag:
         raise HTTPException(status_code=404, detail="Bag not found or not owned by user")
     
-    for field, value in bag_update.dict(exclude_unset=True).items():
+    changes = bag_update.dict(exclude_unset=True)
+    pickup_moved = "pickup_end" in changes and changes["pickup_end"] != db_bag.pickup_end
+    for field, value in changes.items():
         setattr(db_bag, field, value)
+    db_bag.version = SurpriseBag.version + 1
     
-    db.commit()
-    db.refresh(db_bag)
+    if "title" in changes or "description" in changes:
+        await get_search_backend(db).index_bag(db, db_bag, recommend_tags(db_bag.title, db_bag.description))
+    
+    if pickup_moved:
+        # Reminders sent for the old pickup_end are void; open orders get
+        # one for the new time, and still-queued old ones become no-ops
+        await db.execute(
+            update(Order)
+            .where(Order.bag_id == bag_id, Order.status.in_([OrderStatus.pending, OrderStatus.confirmed]))
+            .values(reminder_sent_at=None)
+            .execution_options(synchronize_session=False)
+        )
+    
+    await db.execute(*bump_versions(db, "bag"))
+    await db.commit()
+    await db.refresh(db_bag)
+    if pickup_moved:
+        background_tasks.add_task(schedule_pickup_reminders, db_bag.id, db_bag.pickup_end)
     return db_bag
 
-@router.get("/{bag_id}", response_model=SurpriseBagOut)
+@router.get("/{bag_id}", response_model=SurpriseBagExpandedOut, response_model_exclude_unset=True)
 async def get_bag(
     bag_id: uuid.UUID,
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    expand: Optional[str] = Query(None, description="Comma-separated: business"),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get details of a specific surprise bag"""
-    db_bag = db.query(SurpriseBag).filter(SurpriseBag.id == bag_id).first()
-    if not db_bag:
+    """Get details of a specific surprise bag; answers If-None-Match with 304 when unchanged"""
+    expand_paths = parse_expand(expand, BAG_EXPANSIONS)
+    # The bag's own version, not the catalogue counter: other bags' sales
+    # leave this tag and cache entry alone
+    version = await db.scalar(select(SurpriseBag.version).where(SurpriseBag.id == bag_id))
+    if version is None:
         raise HTTPException(status_code=404, detail="Bag not found")
-    return db_bag
+    versions = {"bag": version}
+    if "business" in expand_paths:
+        versions.update(await get_versions(db, "shop"))
+    etag = make_etag(versions)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    async def load_bag():
+        result = await db.execute(select(SurpriseBag).where(SurpriseBag.id == bag_id))
+        db_bag = result.scalars().first()
+        return SurpriseBagOut.model_validate(db_bag).model_dump(mode="json") if db_bag else None
+
+    bag = await get_or_load(versioned_key(entity_key("bag", bag_id), {"bag": version}), load_bag)
+    if not bag:
+        raise HTTPException(status_code=404, detail="Bag not found")
+    if "business" in expand_paths:
+        # Both halves are cached on their own, each under its own version
+        bag = {**bag, "business": await get_cached_shop(db, uuid.UUID(bag["business_id"]), versions["shop"])}
+    set_etag(response, etag)
+    return bag
 
 @router.delete("/{bag_id}", status_code=204)
 async def delete_bag(
     bag_id: uuid.UUID,
     current_user: User = Depends(get_current_business_owner),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete a specific surprise bag"""
-    db_bag = db.query(SurpriseBag).filter(
+    result = await db.execute(select(SurpriseBag).where(
         SurpriseBag.id == bag_id,
         SurpriseBag.business_id == current_user.id
-    ).first()
+    ))
+    db_bag = result.scalars().first()
     
     if not db_bag:
         raise HTTPException(status_code=404, detail="Bag not found or not owned by user")
     
-    db.delete(db_bag)
-    db.commit()
+    await get_search_backend(db).remove_bag(db, db_bag.id)
+    await db.delete(db_bag)
+    await db.execute(*bump_versions(db, "bag"))
+    await db.commit()
     return None
 
-@router.get("/", response_model=List[SurpriseBagOut])
+@router.get("/", response_model=List[SurpriseBagExpandedOut])
 async def list_bags(
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    expand: Optional[str] = Query(None, description="Comma-separated: business"),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """List all surprise bags with pagination"""
-    bags = db.query(SurpriseBag).offset(skip).limit(limit).all()
-    return bags
\ No newline at end of file
+    """List surprise bags, newest first, one cursor page at a time; answers If-None-Match with 304 when unchanged"""
+    expand_paths = parse_expand(expand, BAG_EXPANSIONS)
+    versions = await get_versions(db, "bag", *(["shop"] if "business" in expand_paths else []))
+    # Sales only bump the bags they touch, so the tag also covers the
+    # version of every row on the page
+    page_rows = await db.execute(
+        keyset_page(select(SurpriseBag.id, SurpriseBag.version), SurpriseBag.created_at, SurpriseBag.id, cursor, limit)
+    )
+    versions["rows"] = row_versions(page_rows.all())
+    etag = make_etag(versions)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    async def load_page():
+        if expand_paths:
+            query = select(SurpriseBag).options(*bag_loader_options(expand_paths))
+        else:
+            query = select(*columns(SurpriseBag, SurpriseBagOut))
+        query = keyset_page(query, SurpriseBag.created_at, SurpriseBag.id, cursor, limit)
+        result = await db.execute(query)
+        if expand_paths:
+            bags = finish_page(result.scalars().all(), limit, response)
+            body = dumps([bag_out(bag, expand_paths) for bag in bags])
+        else:
+            body = dump_rows(finish_page(result.all(), limit, response))
+        return {"body": body.decode(), "next_cursor": response.headers.get(NEXT_CURSOR_HEADER)}
+
+    # Pages are cached already encoded, so a hit skips serialization too
+    key = list_key("bag", "json", ",".join(sorted(expand_paths)), cursor, limit)
+    page = await get_or_load(versioned_key(key, versions), load_page)
+    return set_etag(json_response(page["body"], page["next_cursor"]), etag)
\ No newline at end of file
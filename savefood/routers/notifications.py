@@ -1,10 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, WebSocket, WebSocketDisconnect, status
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
 from models import Notification, User
 from schemas import NotificationCreate, NotificationUpdate, NotificationOut
-from database import get_db
-from routers.auth import get_current_user
+from database import get_async_db
+from routers.auth import get_current_user, get_user_from_token
+from pagination import keyset_page, finish_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER
+from serialization import columns, dump_rows, json_response
+from notification_hub import notification_hub, notification_event
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,7 +20,7 @@ logger.info("Notifications router initialized")
 @router.post("/", response_model=NotificationOut, status_code=status.HTTP_201_CREATED)
 async def create_notification(
     notification_data: NotificationCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Create a new notification for a user"""
@@ -29,42 +34,112 @@ async def create_notification(
         is_read=False
     )
     db.add(new_notification)
-    db.commit()
-    db.refresh(new_notification)
+    await db.commit()
+    await db.refresh(new_notification)
+    await notification_hub.publish(current_user.id, notification_event(
+        id=new_notification.id,
+        type=new_notification.type,
+        title=new_notification.title,
+        message=new_notification.message,
+        order_id=new_notification.order_id
+    ))
     logger.info(f"Notification created: {new_notification.id}")
     return new_notification
 
 @router.get("/", response_model=List[NotificationOut])
 async def list_notifications(
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    """List all notifications for the current user"""
-    logger.info(f"Fetching notifications for user: {current_user.email}, skip={skip}, limit={limit}")
-    notifications = (
-        db.query(Notification)
-        .filter(Notification.user_id == current_user.id)
-        .offset(skip)
-        .limit(limit)
-        .all()
+    """List notifications for the current user, newest first"""
+    logger.info(f"Fetching notifications for user: {current_user.email}, cursor={cursor}, limit={limit}")
+    query = keyset_page(
+        select(*columns(Notification, NotificationOut)).where(Notification.user_id == current_user.id),
+        Notification.created_at, Notification.id, cursor, limit
     )
-    return notifications
+    result = await db.execute(query)
+    notifications = finish_page(result.all(), limit, response)
+    return json_response(dump_rows(notifications), response.headers.get(NEXT_CURSOR_HEADER))
+
+@router.get("/unread-count")
+async def unread_count(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Number of unread notifications for the current user, counted on ix_notification_user_unread"""
+    count = await db.scalar(
+        select(func.count())
+        .select_from(Notification)
+        .where(Notification.user_id == current_user.id, Notification.is_read == False)
+    )
+    return {"unread": count}
+
+@router.put("/read-all")
+async def mark_all_read(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Mark every unread notification of the current user as read in one UPDATE"""
+    logger.info(f"Marking all notifications read for user: {current_user.email}")
+    result = await db.execute(
+        update(Notification)
+        .where(Notification.user_id == current_user.id, Notification.is_read == False)
+        .values(is_read=True)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return {"updated": result.rowcount}
+
+@router.websocket("/ws")
+async def notification_stream(
+    websocket: WebSocket,
+    token: str = Query(...),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Push the current user's notifications and order updates as they happen"""
+    try:
+        user = await get_user_from_token(token, db)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    # Don't hold a pooled connection for the life of the socket
+    await db.close()
+    await websocket.accept()
+    logger.info(f"Notification stream opened for user: {user.email}")
+
+    async with notification_hub.subscribe(user.id) as subscription:
+        async def forward():
+            while True:
+                await websocket.send_json(await subscription.get())
+
+        sender = asyncio.create_task(forward())
+        try:
+            # Nothing is expected from the client; reading is how a
+            # disconnect is noticed while no events are flowing
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sender.cancel()
+    logger.info(f"Notification stream closed for user: {user.email}")
 
 @router.get("/{notification_id}", response_model=NotificationOut)
 async def get_notification(
     notification_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Get a specific notification by ID"""
     logger.info(f"Fetching notification {notification_id} for user: {current_user.email}")
-    notification = (
-        db.query(Notification)
-        .filter(Notification.id == notification_id, Notification.user_id == current_user.id)
-        .first()
+    result = await db.execute(
+        select(Notification)
+        .where(Notification.id == notification_id, Notification.user_id == current_user.id)
     )
+    notification = result.scalars().first()
     if not notification:
         logger.error(f"Notification not found: {notification_id}")
         raise HTTPException(
@@ -77,16 +152,16 @@ async def get_notification(
 async def update_notification(
     notification_id: str,
     notification_data: NotificationUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Update a notification (e.g., mark as read)"""
     logger.info(f"Updating notification {notification_id} for user: {current_user.email}")
-    notification = (
-        db.query(Notification)
-        .filter(Notification.id == notification_id, Notification.user_id == current_user.id)
-        .first()
+    result = await db.execute(
+        select(Notification)
+        .where(Notification.id == notification_id, Notification.user_id == current_user.id)
     )
+    notification = result.scalars().first()
     if not notification:
         logger.error(f"Notification not found: {notification_id}")
         raise HTTPException(
@@ -95,30 +170,30 @@ async def update_notification(
         )
     for key, value in notification_data.dict(exclude_unset=True).items():
         setattr(notification, key, value)
-    db.commit()
-    db.refresh(notification)
+    await db.commit()
+    await db.refresh(notification)
     logger.info(f"Notification updated: {notification_id}")
     return notification
 
 @router.delete("/{notification_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_notification(
     notification_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Delete a notification"""
     logger.info(f"Deleting notification {notification_id} for user: {current_user.email}")
-    notification = (
-        db.query(Notification)
-        .filter(Notification.id == notification_id, Notification.user_id == current_user.id)
-        .first()
+    result = await db.execute(
+        select(Notification)
+        .where(Notification.id == notification_id, Notification.user_id == current_user.id)
     )
+    notification = result.scalars().first()
     if not notification:
         logger.error(f"Notification not found: {notification_id}")
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Notification not found"
         )
-    db.delete(notification)
-    db.commit()
+    await db.delete(notification)
+    await db.commit()
     logger.info(f"Notification deleted: {notification_id}")
\ No newline at end of file
@@ -1,153 +1,300 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional, Union
+from contextlib import asynccontextmanager
+import asyncio
 import uuid
-from datetime import datetime, UTC
 from fastapi import status
 import logging
 
-from database import get_db
-from models import Order, SurpriseBag, User
-from schemas import OrderCreate, OrderOut, OrderStatus
+from database import get_async_db, upsert
+from models import BusinessDailySales, Order, SurpriseBag, User, utcnow
+from schemas import OrderCreate, OrderOut, OrderExpandedOut, OrderStatus
 from routers.auth import get_current_customer, get_current_business_owner, get_current_user
+from pagination import keyset_page, finish_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER
+from serialization import columns, dump_rows, dumps, json_response, parse_expand, subpaths
+from routers.bags import bag_loader_options, bag_out
+from tasks import schedule_pickup_reminders, backfill_order_businesses
+from notification_hub import notification_hub, order_event
 
-router = APIRouter()
+@asynccontextmanager
+async def lifespan(app):
+    # Shop owners list orders by orders.business_id; fill it in for orders
+    # placed before it existed before serving them
+    await asyncio.to_thread(backfill_order_businesses)
+    yield
+
+router = APIRouter(lifespan=lifespan)
 logger = logging.getLogger(__name__)
 
+ORDER_EXPANSIONS = ("bag", "bag.business")
+
+async def record_sales(db: AsyncSession, business_id: uuid.UUID, order: Order, **deltas):
+    """Add an order transition to today's sales row for its bag, in the caller's transaction"""
+    statement = upsert(db, BusinessDailySales).values(
+        business_id=business_id, bag_id=order.bag_id, day=utcnow().date(), **deltas
+    )
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[BusinessDailySales.business_id, BusinessDailySales.bag_id, BusinessDailySales.day],
+        set_={name: getattr(BusinessDailySales, name) + delta for name, delta in deltas.items()}
+    ))
+
+async def publish_order(order: Order, *user_ids):
+    """Push the order's new status to each user with a live notification stream"""
+    event = order_event(order)
+    for user_id in user_ids:
+        if user_id:
+            await notification_hub.publish(user_id, event)
+
+async def transition_order(db: AsyncSession, order_id: uuid.UUID, expected: Union[OrderStatus, List[OrderStatus]], new_status: OrderStatus):
+    """Move an order from expected (one status or a list) to new_status with one conditional UPDATE.
+
+    Concurrent requests may all have read the old status; only the one
+    whose UPDATE matches goes on, the others get a 409.
+    """
+    expected = expected if isinstance(expected, list) else [expected]
+    result = await db.execute(
+        update(Order)
+        .where(Order.id == order_id, Order.status.in_(expected))
+        .values(status=new_status, updated_at=utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail=f"Order is no longer {' or '.join(status.value for status in expected)}"
+        )
+
 @router.post("/", response_model=OrderOut, status_code=status.HTTP_201_CREATED)
 async def create_order(
     order_data: OrderCreate,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_customer)
 ):
     """Create a new order (status: pending)"""
     logger.info(f"Attempting to create order for user: {current_user.email}")
     
-    # Verify bag exists and has sufficient quantity
-    bag = db.query(SurpriseBag).filter(
-        SurpriseBag.id == order_data.bag_id,
-        SurpriseBag.is_active == True,
-        SurpriseBag.quantity_available >= order_data.quantity
-    ).first()
+    # Reserve stock with a single conditional UPDATE so concurrent orders
+    # cannot both pass the availability check and oversell the bag
+    reserved = await db.execute(
+        update(SurpriseBag)
+        .where(
+            SurpriseBag.id == order_data.bag_id,
+            SurpriseBag.is_active == True,
+            SurpriseBag.quantity_available >= order_data.quantity
+        )
+        .values(
+            quantity_available=SurpriseBag.quantity_available - order_data.quantity,
+            quantity_sold=func.coalesce(SurpriseBag.quantity_sold, 0) + order_data.quantity,
+            version=SurpriseBag.version + 1
+        )
+        .execution_options(synchronize_session=False)
+    )
     
-    if not bag:
+    if reserved.rowcount != 1:
+        await db.rollback()
         logger.error(f"Bag not available: {order_data.bag_id}")
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Bag not available or insufficient quantity"
         )
 
-    # Create new order
+    discount_price, pickup_end, business_id = (await db.execute(
+        select(SurpriseBag.discount_price, SurpriseBag.pickup_end, SurpriseBag.business_id)
+        .where(SurpriseBag.id == order_data.bag_id)
+    )).one()
+
+    # Create new order in the same transaction as the reservation
     new_order = Order(
         customer_id=current_user.id,
         bag_id=order_data.bag_id,
+        business_id=business_id,
         quantity=order_data.quantity,
-        total_price=bag.discount_price * order_data.quantity,
+        total_price=discount_price * order_data.quantity,
         status=OrderStatus.pending,
         pickup_code=str(uuid.uuid4())[:8].upper(),
-        created_at=datetime.now(UTC)
+        created_at=utcnow()
     )
 
-    # Update bag quantity
-    bag.quantity_available -= order_data.quantity
-
     # Save to database
     db.add(new_order)
-    db.commit()
-    db.refresh(new_order)
+    await db.commit()
+    await db.refresh(new_order)
+    # Published after the response is sent, so checkout never waits on the broker
+    background_tasks.add_task(schedule_pickup_reminders, order_data.bag_id, pickup_end, new_order.id)
+    await publish_order(new_order, business_id)
     
     return new_order
 
 @router.put("/{order_id}/confirm", response_model=OrderOut)
 async def confirm_order(
     order_id: uuid.UUID,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_business_owner),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Confirm an order (status: pending → confirmed)"""
-    db_order = db.query(Order).join(SurpriseBag).filter(
+    result = await db.execute(select(Order, SurpriseBag.pickup_end).join(SurpriseBag).where(
         Order.id == order_id,
         SurpriseBag.business_id == current_user.id,
         Order.status == OrderStatus.pending
-    ).first()
+    ))
+    row = result.first()
     
-    if not db_order:
+    if not row:
         raise HTTPException(status_code=404, detail="Order not found or already processed")
+    db_order, pickup_end = row
     
-    db_order.status = OrderStatus.confirmed
-    db_order.updated_at = datetime.now(UTC)
-    db.commit()
-    db.refresh(db_order)
+    await transition_order(db, order_id, OrderStatus.pending, OrderStatus.confirmed)
+    await record_sales(db, current_user.id, db_order, confirmed_orders=1)
+    await db.commit()
+    await db.refresh(db_order)
+    # Covers orders placed before reminders were scheduled at creation;
+    # the claim keeps this from sending twice
+    background_tasks.add_task(schedule_pickup_reminders, db_order.bag_id, pickup_end, db_order.id)
+    await publish_order(db_order, db_order.customer_id)
     return db_order
 
 @router.put("/{order_id}/complete", response_model=OrderOut)
 async def complete_order(
     order_id: uuid.UUID,
     current_user: User = Depends(get_current_business_owner),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Complete an order (status: confirmed → completed)"""
-    db_order = db.query(Order).join(SurpriseBag).filter(
+    result = await db.execute(select(Order).join(SurpriseBag).where(
         Order.id == order_id,
         SurpriseBag.business_id == current_user.id,
         Order.status == OrderStatus.confirmed
-    ).first()
+    ))
+    db_order = result.scalars().first()
     
     if not db_order:
         raise HTTPException(status_code=404, detail="Order not found or not confirmed")
     
-    db_order.status = OrderStatus.completed
-    db_order.updated_at = datetime.now(UTC)
-    db.commit()
-    db.refresh(db_order)
+    await transition_order(db, order_id, OrderStatus.confirmed, OrderStatus.completed)
+    await record_sales(
+        db, current_user.id, db_order,
+        completed_orders=1, units_sold=db_order.quantity, revenue=db_order.total_price
+    )
+    await db.commit()
+    await db.refresh(db_order)
+    await publish_order(db_order, db_order.customer_id)
     return db_order
 
 @router.put("/{order_id}/cancel", response_model=OrderOut)
 async def cancel_order(
     order_id: uuid.UUID,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Cancel an order (returns quantity if not completed)"""
-    db_order = db.query(Order).filter(Order.id == order_id).first()
+    """Cancel a pending or confirmed order and return its quantity to the bag"""
+    result = await db.execute(select(Order).where(Order.id == order_id))
+    db_order = result.scalars().first()
     if not db_order:
         raise HTTPException(status_code=404, detail="Order not found")
     
     if current_user.role == "customer" and db_order.customer_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not your order")
     elif current_user.role == "business_owner":
-        db_bag = db.query(SurpriseBag).filter(
+        result = await db.execute(select(SurpriseBag).where(
             SurpriseBag.id == db_order.bag_id,
             SurpriseBag.business_id == current_user.id
-        ).first()
+        ))
+        db_bag = result.scalars().first()
         if not db_bag:
             raise HTTPException(status_code=403, detail="Not your business order")
     
-    if db_order.status in [OrderStatus.pending, OrderStatus.confirmed]:
-        db_bag = db.query(SurpriseBag).filter(SurpriseBag.id == db_order.bag_id).first()
-        db_bag.quantity_available += db_order.quantity
+    # Only the request that actually moves the order out of an open state
+    # returns its quantity, so concurrent cancels cannot restock twice;
+    # completed and cancelled orders get a 409
+    await transition_order(db, order_id, [OrderStatus.pending, OrderStatus.confirmed], OrderStatus.cancelled)
+    business_id = await db.scalar(
+        update(SurpriseBag)
+        .where(SurpriseBag.id == db_order.bag_id)
+        .values(
+            quantity_available=SurpriseBag.quantity_available + db_order.quantity,
+            quantity_sold=func.coalesce(SurpriseBag.quantity_sold, 0) - db_order.quantity,
+            version=SurpriseBag.version + 1
+        )
+        .returning(SurpriseBag.business_id)
+        .execution_options(synchronize_session=False)
+    )
+    await record_sales(db, business_id, db_order, cancelled_orders=1)
     
-    db_order.status = OrderStatus.cancelled
-    db_order.updated_at = datetime.now(UTC)
-    db.commit()
-    db.refresh(db_order)
+    await db.commit()
+    await db.refresh(db_order)
+    await publish_order(db_order, db_order.customer_id, business_id)
     return db_order
 
-@router.get("/", response_model=List[OrderOut])
+def visible_orders(query, current_user: User):
+    """Restrict an Order query to what the user may see: their own, their shop's, or all for admins"""
+    if current_user.role == "customer":
+        return query.where(Order.customer_id == current_user.id)
+    if current_user.role == "business_owner":
+        # business_id is copied from the bag, so the shop's orders page
+        # straight off ix_order_business_created
+        return query.where(Order.business_id == current_user.id)
+    return query
+
+def order_loader_options(expand_paths) -> list:
+    if "bag" not in expand_paths:
+        return []
+    load_bag = selectinload(Order.bag)
+    return bag_loader_options(subpaths(expand_paths, "bag"), load_bag) or [load_bag]
+
+def order_out(order: Order, expand_paths) -> dict:
+    """OrderOut as a dict, plus the expansions, which must have been eager loaded"""
+    data = OrderOut.model_validate(order).model_dump(mode="json")
+    if "bag" in expand_paths:
+        data["bag"] = bag_out(order.bag, subpaths(expand_paths, "bag"))
+    return data
+
+@router.get("/", response_model=List[OrderExpandedOut])
 async def list_orders(
+    response: Response,
     status: Optional[OrderStatus] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    expand: Optional[str] = Query(None, description="Comma-separated: bag, bag.business"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """List orders with optional status filter"""
-    query = db.query(Order)
-    
-    if current_user.role == "customer":
-        query = query.filter(Order.customer_id == current_user.id)
-    elif current_user.role == "business_owner":
-        query = query.join(SurpriseBag).filter(SurpriseBag.business_id == current_user.id)
+    """List orders with optional status filter, newest first, one cursor page at a time"""
+    expand_paths = parse_expand(expand, ORDER_EXPANSIONS)
+    if expand_paths:
+        query = select(Order).options(*order_loader_options(expand_paths))
+    else:
+        query = select(*columns(Order, OrderOut))
+    query = visible_orders(query, current_user)
     
     if status:
-        query = query.filter(Order.status == status)
+        query = query.where(Order.status == status)
     
-    return query.order_by(Order.created_at.desc()).all()
\ No newline at end of file
+    result = await db.execute(keyset_page(query, Order.created_at, Order.id, cursor, limit))
+    if expand_paths:
+        orders = finish_page(result.scalars().all(), limit, response)
+        body = dumps([order_out(order, expand_paths) for order in orders])
+    else:
+        body = dump_rows(finish_page(result.all(), limit, response))
+    return json_response(body, response.headers.get(NEXT_CURSOR_HEADER))
+
+@router.get("/{order_id}", response_model=OrderExpandedOut, response_model_exclude_unset=True)
+async def get_order(
+    order_id: uuid.UUID,
+    expand: Optional[str] = Query(None, description="Comma-separated: bag, bag.business"),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Get one of the user's orders"""
+    expand_paths = parse_expand(expand, ORDER_EXPANSIONS)
+    query = visible_orders(select(Order), current_user).where(Order.id == order_id)
+    result = await db.execute(query.options(*order_loader_options(expand_paths)))
+    db_order = result.scalars().first()
+    if not db_order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return order_out(db_order, expand_paths)
\ No newline at end of file
@@ -1,54 +1,103 @@
 # routers/reviews.py
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
 import uuid
 
-from database import get_db
-from models import Order, User, SurpriseBag  # Added SurpriseBag import
-from schemas import OrderOut, OrderUpdate  # No need for SurpriseBag here since we use model directly
+from database import get_async_db, upsert
+from models import BusinessRating, Order, User, SurpriseBag, utcnow
+from schemas import OrderOut, RatingSummaryOut, ReviewCreate
 from routers.auth import get_current_customer
-from schemas import OrderOut, OrderCreate
+from pagination import keyset_page, finish_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
 router = APIRouter(tags=["Reviews"])
 
+RATING_BUCKETS = {rating: getattr(BusinessRating, f"rating_{rating}") for rating in range(1, 6)}
+
+async def apply_rating(db: AsyncSession, business_id: uuid.UUID, new: int, old: Optional[int]):
+    """Fold one new or changed rating into the business's totals, in the caller's transaction"""
+    deltas = {BusinessRating.rating_count: 0 if old else 1, BusinessRating.rating_sum: new - (old or 0)}
+    deltas[RATING_BUCKETS[new]] = 1
+    if old:
+        deltas[RATING_BUCKETS[old]] = deltas.get(RATING_BUCKETS[old], 0) - 1
+    statement = upsert(db, BusinessRating).values(
+        business_id=business_id, **{column.key: delta for column, delta in deltas.items()}
+    )
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[BusinessRating.business_id],
+        set_={column.key: column + delta for column, delta in deltas.items()}
+    ))
+
 @router.post("/{order_id}/review", response_model=OrderOut)
 async def create_review(
     order_id: uuid.UUID,
-    review_data: OrderUpdate,
+    review_data: ReviewCreate,
     current_user: User = Depends(get_current_customer),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Add a review to a completed order"""
-    order = db.query(Order).filter(
+    result = await db.execute(select(Order, SurpriseBag.business_id).join(SurpriseBag).where(
         Order.id == order_id,
         Order.customer_id == current_user.id,
         Order.status == "completed"
-    ).first()
+    ))
+    row = result.first()
     
-    if not order:
+    if not row:
         raise HTTPException(
             status_code=404,
             detail="Order not found or not completed"
         )
+    order, business_id = row
+    old_rating = order.rating
     
-    if review_data.rating is not None:
-        order.rating = review_data.rating
-    if review_data.feedback is not None:
-        order.feedback = review_data.feedback
+    # Only write if the rating is still the one read above, so two
+    # concurrent reviews of the same order cannot both count
+    changed = await db.execute(
+        update(Order)
+        .where(Order.id == order_id, Order.rating == old_rating if old_rating else Order.rating.is_(None))
+        .values(rating=review_data.rating, feedback=review_data.feedback, reviewed_at=utcnow(), business_id=business_id)
+        .execution_options(synchronize_session=False)
+    )
+    if changed.rowcount != 1:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Review changed concurrently, try again")
+    await apply_rating(db, business_id, review_data.rating, old_rating)
     
-    db.commit()
-    db.refresh(order)
+    await db.commit()
+    await db.refresh(order)
     return order
 
+@router.get("/business/{business_id}/summary", response_model=RatingSummaryOut)
+async def get_business_rating_summary(
+    business_id: uuid.UUID,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Rating count, average and 1-5 histogram for a business, read from its totals row"""
+    totals = await db.get(BusinessRating, business_id)
+    histogram = {rating: getattr(totals, column.key) if totals else 0 for rating, column in RATING_BUCKETS.items()}
+    count = totals.rating_count if totals else 0
+    return {
+        "business_id": business_id,
+        "count": count,
+        "average": round(totals.rating_sum / count, 2) if count else None,
+        "histogram": histogram,
+    }
+
 @router.get("/business/{business_id}", response_model=List[OrderOut])
 async def get_business_reviews(
     business_id: uuid.UUID,
-    db: Session = Depends(get_db)
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get all reviews for a business"""
-    reviews = db.query(Order).join(SurpriseBag).filter(
-        SurpriseBag.business_id == business_id,
-        Order.rating != None
-    ).order_by(Order.updated_at.desc()).all()
-    return reviews
\ No newline at end of file
+    """Get reviews for a business, newest first, one cursor page at a time"""
+    query = select(Order).where(
+        Order.business_id == business_id,
+        Order.rating != None,
+        Order.reviewed_at != None
+    )
+    result = await db.execute(keyset_page(query, Order.reviewed_at, Order.id, cursor, limit))
+    return finish_page(result.scalars().all(), limit, response, key=lambda order: (order.reviewed_at, order.id))
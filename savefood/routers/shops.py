@@ -1,11 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from models import Business, User
-from schemas import ShopCreate, ShopOut, ShopUpdate
-from database import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from datetime import timedelta
+from models import Business, BusinessDailySales, SurpriseBag, User, utcnow
+from schemas import SalesDashboardOut, ShopCreate, ShopOut, ShopUpdate
+from database import get_async_db
 from routers.auth import get_current_business_owner
+from pagination import keyset_page, finish_page, NEXT_CURSOR_HEADER, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from catalog import bump_versions, get_versions, make_etag, not_modified, set_etag, versioned_key
+from cache import entity_key, list_key, get_or_load, get_or_load_page
+from search import get_search_backend
 import logging
+import uuid
 
 logger = logging.getLogger(__name__)
 
@@ -15,12 +22,13 @@ logger.info("Shops router initialized")
 @router.post("/", response_model=ShopOut, status_code=status.HTTP_201_CREATED)
 async def create_shop(
     shop_data: ShopCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_business_owner)
 ):
     """Create a new shop for a business owner"""
     logger.info(f"Creating shop for user: {current_user.email}")
-    existing_shop = db.query(Business).filter(Business.owner_id == current_user.id).first()
+    result = await db.execute(select(Business).where(Business.id == current_user.id))
+    existing_shop = result.scalars().first()
     if existing_shop:
         logger.error(f"User already has a shop: {current_user.id}")
         raise HTTPException(
@@ -28,7 +36,7 @@ async def create_shop(
             detail="User already has a shop"
         )
     new_shop = Business(
-        owner_id=current_user.id,
+        id=current_user.id,
         name=shop_data.name,
         description=shop_data.description,
         address=shop_data.address,
@@ -36,55 +44,156 @@ async def create_shop(
         is_approved=False
     )
     db.add(new_shop)
-    db.commit()
-    db.refresh(new_shop)
+    await db.execute(*bump_versions(db, "shop"))
+    await db.commit()
+    await db.refresh(new_shop)
     logger.info(f"Shop created: {new_shop.id}")
     return new_shop
 
 @router.get("/", response_model=List[ShopOut])
 async def list_shops(
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """List all shops with pagination"""
-    logger.info(f"Fetching shops: skip={skip}, limit={limit}")
-    shops = db.query(Business).offset(skip).limit(limit).all()
-    return shops
+    """List shops, newest first, one cursor page at a time; answers If-None-Match with 304 when unchanged"""
+    logger.info(f"Fetching shops: cursor={cursor}, limit={limit}")
+    versions = await get_versions(db, "shop")
+    etag = make_etag(versions)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    async def load_page():
+        query = keyset_page(select(Business), Business.created_at, Business.id, cursor, limit)
+        result = await db.execute(query)
+        shops = finish_page(result.scalars().all(), limit, response)
+        return {
+            "items": [ShopOut.model_validate(shop).model_dump(mode="json") for shop in shops],
+            "next_cursor": response.headers.get(NEXT_CURSOR_HEADER),
+        }
+
+    set_etag(response, etag)
+    return await get_or_load_page(versioned_key(list_key("shop", cursor, limit), versions), load_page, response)
+
+SALES_COLUMNS = ["confirmed_orders", "completed_orders", "cancelled_orders", "units_sold", "revenue"]
+
+def sales_figures(row) -> dict:
+    """Summed sales columns plus the share of finished orders that were cancelled"""
+    figures = {name: getattr(row, name) or 0 for name in SALES_COLUMNS}
+    figures["revenue"] = float(figures["revenue"])
+    finished = figures["completed_orders"] + figures["cancelled_orders"]
+    figures["cancellation_rate"] = round(figures["cancelled_orders"] / finished, 4) if finished else None
+    return figures
+
+@router.get("/me/dashboard", response_model=SalesDashboardOut)
+async def sales_dashboard(
+    days: int = Query(30, ge=1, le=366),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_business_owner)
+):
+    """Revenue, units, cancellations and sell-through for the owner's shop over the last days.
+
+    Read from business_daily_sales, which order transitions keep current,
+    so the cost depends on days and bags, not on the number of orders.
+    """
+    logger.info(f"Fetching sales dashboard for user: {current_user.email}, days={days}")
+    since = utcnow().date() - timedelta(days=days - 1)
+    sums = [func.sum(getattr(BusinessDailySales, name)).label(name) for name in SALES_COLUMNS]
+    in_range = (BusinessDailySales.business_id == current_user.id, BusinessDailySales.day >= since)
+
+    totals = (await db.execute(select(*sums).where(*in_range))).one()
+    by_day = await db.execute(
+        select(BusinessDailySales.day, *sums).where(*in_range)
+        .group_by(BusinessDailySales.day).order_by(BusinessDailySales.day)
+    )
+    by_bag = await db.execute(
+        select(
+            BusinessDailySales.bag_id, SurpriseBag.title,
+            SurpriseBag.quantity_available, SurpriseBag.quantity_sold, *sums
+        )
+        .outerjoin(SurpriseBag, SurpriseBag.id == BusinessDailySales.bag_id)
+        .where(*in_range)
+        .group_by(
+            BusinessDailySales.bag_id, SurpriseBag.title,
+            SurpriseBag.quantity_available, SurpriseBag.quantity_sold
+        )
+        .order_by(func.sum(BusinessDailySales.revenue).desc())
+    )
+
+    bags = []
+    for row in by_bag:
+        # Stock the bag was listed with: what is left plus what is reserved or sold
+        listed = (row.quantity_available or 0) + (row.quantity_sold or 0)
+        bags.append({
+            "bag_id": row.bag_id,
+            "title": row.title,
+            "sell_through": round(row.units_sold / listed, 4) if row.title is not None and listed else None,
+            **sales_figures(row),
+        })
+    return {
+        "since": since,
+        "totals": sales_figures(totals),
+        "days": [{"day": row.day, **sales_figures(row)} for row in by_day],
+        "bags": bags,
+    }
+
+async def get_cached_shop(db: AsyncSession, shop_id, version: int) -> Optional[dict]:
+    """ShopOut of a shop as a dict, read through the cache; None if it does not exist.
+
+    version is the "shop" catalog version the caller read before calling.
+    """
+    async def load_shop():
+        result = await db.execute(select(Business).where(Business.id == shop_id))
+        shop = result.scalars().first()
+        return ShopOut.model_validate(shop).model_dump(mode="json") if shop else None
+
+    return await get_or_load(versioned_key(entity_key("shop", shop_id), {"shop": version}), load_shop)
 
 @router.get("/{shop_id}", response_model=ShopOut)
 async def get_shop(
-    shop_id: str,
-    db: Session = Depends(get_db)
+    shop_id: uuid.UUID,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get a specific shop by ID"""
+    """Get a specific shop by ID; answers If-None-Match with 304 when unchanged"""
     logger.info(f"Fetching shop: {shop_id}")
-    shop = db.query(Business).filter(Business.id == shop_id).first()
+    versions = await get_versions(db, "shop")
+    etag = make_etag(versions)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+    shop = await get_cached_shop(db, shop_id, versions["shop"])
     if not shop:
         logger.error(f"Shop not found: {shop_id}")
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Shop not found"
         )
+    set_etag(response, etag)
     return shop
 
 @router.put("/{shop_id}", response_model=ShopOut)
 async def update_shop(
-    shop_id: str,
+    shop_id: uuid.UUID,
     shop_data: ShopUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_business_owner)
 ):
     """Update a shop's details"""
     logger.info(f"Updating shop {shop_id} for user: {current_user.email}")
-    shop = db.query(Business).filter(Business.id == shop_id).first()
+    result = await db.execute(select(Business).where(Business.id == shop_id))
+    shop = result.scalars().first()
     if not shop:
         logger.error(f"Shop not found: {shop_id}")
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Shop not found"
         )
-    if shop.owner_id != current_user.id:
+    if shop.id != current_user.id:
         logger.error(f"Unauthorized update attempt by user: {current_user.id}")
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -92,32 +201,38 @@ async def update_shop(
         )
     for key, value in shop_data.dict(exclude_unset=True).items():
         setattr(shop, key, value)
-    db.commit()
-    db.refresh(shop)
+    await db.execute(*bump_versions(db, "shop"))
+    await db.commit()
+    await db.refresh(shop)
     logger.info(f"Shop updated: {shop_id}")
     return shop
 
 @router.delete("/{shop_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_shop(
-    shop_id: str,
-    db: Session = Depends(get_db),
+    shop_id: uuid.UUID,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_business_owner)
 ):
     """Delete a shop"""
     logger.info(f"Deleting shop {shop_id} for user: {current_user.email}")
-    shop = db.query(Business).filter(Business.id == shop_id).first()
+    result = await db.execute(select(Business).where(Business.id == shop_id))
+    shop = result.scalars().first()
     if not shop:
         logger.error(f"Shop not found: {shop_id}")
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Shop not found"
         )
-    if shop.owner_id != current_user.id:
+    if shop.id != current_user.id:
         logger.error(f"Unauthorized delete attempt by user: {current_user.id}")
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not authorized to delete this shop"
         )
-    db.delete(shop)
-    db.commit()
+    # The shop's bags are deleted with it, and unindexed in the same transaction
+    bag_ids = (await db.execute(select(SurpriseBag.id).where(SurpriseBag.business_id == shop_id))).scalars().all()
+    await get_search_backend(db).remove_bags(db, bag_ids)
+    await db.delete(shop)
+    await db.execute(*bump_versions(db, "shop", "bag"))
+    await db.commit()
     logger.info(f"Shop deleted: {shop_id}")
\ No newline at end of file
@@ -1,12 +1,16 @@
 # routers/users.py
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 
-from database import get_db
-from models import User
+from cache import cache
+from database import get_async_db, pool_stats
+from models import SurpriseBag, User
 from schemas import UserOut
-from routers.auth import get_current_user
+from routers.auth import get_current_admin, get_current_user, invalidate_user
+from catalog import bump_versions
+from search import get_search_backend
 
 router = APIRouter(prefix="/users", tags=["Users"])
 
@@ -22,7 +26,7 @@ async def update_user_profile(
     name: str = None,
     phone: str = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Update current user's profile"""
     if name:
@@ -30,16 +34,29 @@ async def update_user_profile(
     if phone:
         current_user.phone = phone
     
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    await invalidate_user(current_user.email)
+    await db.refresh(current_user)
     return current_user
 
 @router.delete("/me")
 async def delete_user(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete current user's account"""
-    db.delete(current_user)
-    db.commit()
-    return {"message": "User account deleted successfully"}
\ No newline at end of file
+    # A business owner's shop and bags are deleted with the account, and
+    # the bags unindexed in the same transaction
+    bag_ids = (await db.execute(select(SurpriseBag.id).where(SurpriseBag.business_id == current_user.id))).scalars().all()
+    await get_search_backend(db).remove_bags(db, bag_ids)
+    await db.delete(current_user)
+    if bag_ids or current_user.role == "business_owner":
+        await db.execute(*bump_versions(db, "shop", "bag"))
+    await db.commit()
+    await invalidate_user(current_user.email)
+    return {"message": "User account deleted successfully"}
+
+@router.get("/stats")
+async def get_stats(current_user: User = Depends(get_current_admin)):
+    """Database pool and cache counters for this process (admins only)"""
+    return {"database": pool_stats(), "cache": cache.stats()}
@@ -1,9 +1,23 @@
-from pydantic import BaseModel, EmailStr, Field
-from datetime import datetime
-from typing import List, Optional
+from pydantic import AfterValidator, BaseModel, EmailStr, Field
+from datetime import date, datetime, time, timezone
+from typing import Annotated, Dict, List, Optional
 from enum import Enum
 from uuid import UUID
 
+def to_naive_utc(value: datetime) -> datetime:
+    # Timestamps are stored as naive UTC; an offset in the input is applied, not dropped
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def time_to_naive_utc(value: time) -> time:
+    if value.tzinfo is not None:
+        value = to_naive_utc(datetime.combine(date(2000, 1, 1), value)).time()
+    return value
+
+UTCDateTime = Annotated[datetime, AfterValidator(to_naive_utc)]
+UTCTime = Annotated[time, AfterValidator(time_to_naive_utc)]
+
 class UserRole(str, Enum):
     customer = "customer"
     business_owner = "business_owner"
@@ -76,8 +90,8 @@ class SurpriseBagCreate(BaseModel):
     original_price: float = Field(..., gt=0)
     discount_price: float = Field(..., gt=0)
     quantity_available: int = Field(..., ge=1)
-    pickup_start: datetime
-    pickup_end: datetime
+    pickup_start: UTCDateTime
+    pickup_end: UTCDateTime
     image_urls: Optional[List[str]] = None
 
 
@@ -87,8 +101,8 @@ class SurpriseBagUpdate(BaseModel):  # Added to fix the ImportError
     original_price: Optional[float] = None
     discount_price: Optional[float] = None
     quantity_available: Optional[int] = None
-    pickup_start: Optional[str] = None
-    pickup_end: Optional[str] = None
+    pickup_start: Optional[UTCDateTime] = None
+    pickup_end: Optional[UTCDateTime] = None
     image_urls: Optional[List[str]] = None
     
 class SurpriseBagOut(BaseModel):
@@ -100,11 +114,52 @@ class SurpriseBagOut(BaseModel):
     discount_price: float
     quantity_available: int
     quantity_sold: int
-    pickup_start: datetime
-    pickup_end: datetime
+    pickup_start: UTCDateTime
+    pickup_end: UTCDateTime
     image_urls: Optional[List[str]]
     is_active: bool
     created_at: datetime
+    template_id: Optional[UUID] = None
+    template_date: Optional[date] = None
+
+    class Config:
+        from_attributes = True
+
+class SurpriseBagExpandedOut(SurpriseBagOut):
+    business: Optional[ShopOut] = None  # with ?expand=business
+
+class BagTemplateCreate(BaseModel):
+    title: str
+    description: Optional[str] = None
+    original_price: float = Field(..., gt=0)
+    discount_price: float = Field(..., gt=0)
+    quantity_available: int = Field(..., ge=1)
+    pickup_start_time: UTCTime  # UTC
+    pickup_end_time: UTCTime  # UTC; at or before the start means the next day
+    weekdays: int = Field(0b1111111, ge=1, le=0b1111111)  # bitmask, 1 is Monday, 64 is Sunday
+    starts_on: Optional[date] = None
+    ends_on: Optional[date] = None
+    image_urls: Optional[List[str]] = None
+
+class BagTemplateUpdate(BaseModel):
+    title: Optional[str] = None
+    description: Optional[str] = None
+    original_price: Optional[float] = Field(None, gt=0)
+    discount_price: Optional[float] = Field(None, gt=0)
+    quantity_available: Optional[int] = Field(None, ge=1)
+    pickup_start_time: Optional[UTCTime] = None
+    pickup_end_time: Optional[UTCTime] = None
+    weekdays: Optional[int] = Field(None, ge=1, le=0b1111111)
+    starts_on: Optional[date] = None
+    ends_on: Optional[date] = None
+    image_urls: Optional[List[str]] = None
+    is_active: Optional[bool] = None
+
+class BagTemplateOut(BagTemplateCreate):
+    id: UUID
+    business_id: UUID
+    is_active: bool
+    created_at: datetime
 
     class Config:
         from_attributes = True
@@ -123,6 +178,7 @@ class OrderOut(BaseModel):
     pickup_code: Optional[str]
     rating: Optional[int]
     feedback: Optional[str]
+    reviewed_at: Optional[datetime] = None
     created_at: datetime
     updated_at: datetime
 
@@ -141,6 +197,9 @@ class NotificationCreate(BaseModel):
 class NotificationUpdate(BaseModel):
     is_read: Optional[bool] = None
 
+class OrderExpandedOut(OrderOut):
+    bag: Optional[SurpriseBagExpandedOut] = None  # with ?expand=bag or ?expand=bag.business
+
 class NotificationOut(BaseModel):
     id: UUID
     user_id: UUID
@@ -163,9 +222,46 @@ class ReviewOut(BaseModel):
     rating: int
     feedback: Optional[str]
 
+class RatingSummaryOut(BaseModel):
+    business_id: UUID
+    count: int
+    average: Optional[float]
+    histogram: Dict[int, int]
+
+class SalesFigures(BaseModel):
+    confirmed_orders: int
+    completed_orders: int
+    cancelled_orders: int
+    units_sold: int
+    revenue: float
+    cancellation_rate: Optional[float]
+
+class DailySalesOut(SalesFigures):
+    day: date
+
+class BagSalesOut(SalesFigures):
+    bag_id: UUID
+    title: Optional[str]
+    sell_through: Optional[float]
+
+class SalesDashboardOut(BaseModel):
+    since: date
+    totals: SalesFigures
+    days: List[DailySalesOut]
+    bags: List[BagSalesOut]
+
+class BagImportError(BaseModel):
+    row: int
+    errors: List[str]
+
+class BagImportOut(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[BagImportError]  # the first BAG_IMPORT_MAX_ERRORS rejected rows
+
 class TagRecommendation(BaseModel):
     title: str
-    description: str
+    description: Optional[str] = None
 
 class Token(BaseModel):
     access_token: str
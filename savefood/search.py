@@ -0,0 +1,201 @@
+# search.py
+import re
+import uuid
+from typing import List, Optional, Tuple
+
+from sqlalchemy import bindparam, column, delete, insert, or_, select, table, text, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql import Executable
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import SurpriseBag
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(value: Optional[str]) -> List[str]:
+    """Lowercase word tokens, safe to splice into a full-text query"""
+    return TOKEN_RE.findall((value or "").lower())
+
+class SearchBackend:
+    """Keeps the bag search index in sync and answers ranked queries.
+
+    index_bag and remove_bag run inside the caller's transaction, so the
+    index commits or rolls back together with the bag itself.
+    """
+
+    async def index_bag(self, db: AsyncSession, bag: SurpriseBag, tags: List[str]):
+        raise NotImplementedError
+
+    def new_bags_insert(self, bags: List[SurpriseBag], tags: List[List[str]]) -> Optional[Tuple[Executable, List[dict]]]:
+        """(statement, parameter rows) indexing freshly inserted bags in one executemany, or None.
+
+        Returned rather than executed so sync code such as the Celery tasks
+        can run it on its own session.
+        """
+        return None
+
+    async def index_new_bags(self, db: AsyncSession, bags: List[SurpriseBag], tags: List[List[str]]):
+        """Index freshly inserted bags in bulk; nothing to replace, so no delete"""
+        statement = self.new_bags_insert(bags, tags)
+        if statement:
+            await db.execute(*statement)
+
+    async def remove_bag(self, db: AsyncSession, bag_id: uuid.UUID):
+        raise NotImplementedError
+
+    async def remove_bags(self, db: AsyncSession, bag_ids: List[uuid.UUID]):
+        """Unindex bags deleted in bulk, such as a shop's bags deleted with it"""
+        for bag_id in bag_ids:
+            await self.remove_bag(db, bag_id)
+
+    def clear_index(self) -> Optional[Executable]:
+        """Statement emptying the index before a full rebuild, or None when there is no index"""
+        return None
+
+    async def search(self, db: AsyncSession, query: str, tags: List[str], skip: int, limit: int) -> List[uuid.UUID]:
+        """Ids of active bags matching every query term and tag, best match first"""
+        raise NotImplementedError
+
+class SQLiteFTSBackend(SearchBackend):
+    """FTS5 virtual table ranked with bm25, title weighted above description and tags"""
+
+    fts = table(
+        "surprise_bags_fts",
+        column("bag_id"), column("title"), column("description"), column("tags")
+    )
+    # bm25 weights per column: bag_id (unindexed), title, description, tags
+    SEARCH_SQL = text(
+        "SELECT surprise_bags_fts.bag_id FROM surprise_bags_fts "
+        "JOIN surprise_bags ON surprise_bags.id = surprise_bags_fts.bag_id "
+        "WHERE surprise_bags_fts MATCH :match AND surprise_bags.is_active = 1 "
+        "ORDER BY bm25(surprise_bags_fts, 0.0, 10.0, 4.0, 2.0), surprise_bags.created_at DESC "
+        "LIMIT :limit OFFSET :skip"
+    )
+
+    async def index_bag(self, db, bag, tags):
+        await self.remove_bag(db, bag.id)
+        await db.execute(insert(self.fts).values(
+            bag_id=bag.id.hex,
+            title=bag.title,
+            description=bag.description or "",
+            tags=" ".join(tags)
+        ))
+
+    def new_bags_insert(self, bags, tags):
+        if not bags:
+            return None
+        return insert(self.fts), [
+            {"bag_id": bag.id.hex, "title": bag.title, "description": bag.description or "", "tags": " ".join(bag_tags)}
+            for bag, bag_tags in zip(bags, tags)
+        ]
+
+    async def remove_bag(self, db, bag_id):
+        await db.execute(delete(self.fts).where(self.fts.c.bag_id == bag_id.hex))
+
+    async def remove_bags(self, db, bag_ids):
+        # The FTS table has no foreign key, so cascaded bag deletes leave its rows behind
+        if bag_ids:
+            await db.execute(delete(self.fts).where(self.fts.c.bag_id.in_([bag_id.hex for bag_id in bag_ids])))
+
+    def clear_index(self):
+        return delete(self.fts)
+
+    async def search(self, db, query, tags, skip, limit):
+        # Quote every token so user input cannot inject FTS5 syntax; the
+        # trailing * lets partially typed words match
+        terms = [f'"{token}"*' for token in tokenize(query)]
+        terms += [f'tags : "{tag}"' for tag in tags]
+        if not terms:
+            return []
+        result = await db.execute(self.SEARCH_SQL, {"match": " AND ".join(terms), "skip": skip, "limit": limit})
+        return [uuid.UUID(row.bag_id) for row in result]
+
+class PostgresSearchBackend(SearchBackend):
+    """tsvector table with a GIN index, ranked with ts_rank"""
+
+    search_table = table("surprise_bags_search", column("bag_id"), column("document"))
+    SEARCH_SQL = text(
+        "SELECT surprise_bags_search.bag_id FROM surprise_bags_search "
+        "JOIN surprise_bags ON surprise_bags.id = surprise_bags_search.bag_id, "
+        "to_tsquery('english', :tsquery) AS query "
+        "WHERE surprise_bags_search.document @@ query AND surprise_bags.is_active "
+        "ORDER BY ts_rank(surprise_bags_search.document, query) DESC, surprise_bags.created_at DESC "
+        "LIMIT :limit OFFSET :skip"
+    )
+
+    @staticmethod
+    def document(title, description, tags):
+        return (
+            func.setweight(func.to_tsvector("english", title), "A")
+            .op("||")(func.setweight(func.to_tsvector("english", description), "B"))
+            .op("||")(func.setweight(func.to_tsvector("english", tags), "C"))
+        )
+
+    async def index_bag(self, db, bag, tags):
+        document = self.document(bag.title, bag.description or "", " ".join(tags))
+        statement = pg_insert(self.search_table).values(bag_id=bag.id, document=document)
+        await db.execute(statement.on_conflict_do_update(
+            index_elements=["bag_id"], set_={"document": statement.excluded.document}
+        ))
+
+    def new_bags_insert(self, bags, tags):
+        if not bags:
+            return None
+        statement = insert(self.search_table).values(
+            bag_id=bindparam("bag_id"),
+            document=self.document(bindparam("title"), bindparam("description"), bindparam("tags"))
+        )
+        return statement, [
+            {"bag_id": bag.id, "title": bag.title, "description": bag.description or "", "tags": " ".join(bag_tags)}
+            for bag, bag_tags in zip(bags, tags)
+        ]
+
+    async def remove_bag(self, db, bag_id):
+        await db.execute(delete(self.search_table).where(self.search_table.c.bag_id == bag_id))
+
+    async def remove_bags(self, db, bag_ids):
+        if bag_ids:
+            await db.execute(delete(self.search_table).where(self.search_table.c.bag_id.in_(bag_ids)))
+
+    def clear_index(self):
+        return delete(self.search_table)
+
+    async def search(self, db, query, tags, skip, limit):
+        terms = [f"{token}:*" for token in tokenize(query)]
+        terms += [f"{tag}:C" for tag in tags]
+        if not terms:
+            return []
+        result = await db.execute(self.SEARCH_SQL, {"tsquery": " & ".join(terms), "skip": skip, "limit": limit})
+        return [uuid.UUID(str(row.bag_id)) for row in result]
+
+class LikeSearchBackend(SearchBackend):
+    """Unindexed fallback for databases without a full-text backend"""
+
+    async def index_bag(self, db, bag, tags):
+        pass
+
+    async def remove_bag(self, db, bag_id):
+        pass
+
+    async def search(self, db, query, tags, skip, limit):
+        terms = tokenize(query) + tags
+        if not terms:
+            return []
+        statement = select(SurpriseBag.id).where(SurpriseBag.is_active == True)
+        for term in terms:
+            statement = statement.where(or_(
+                SurpriseBag.title.ilike(f"%{term}%"),
+                SurpriseBag.description.ilike(f"%{term}%")
+            ))
+        statement = statement.order_by(SurpriseBag.created_at.desc()).offset(skip).limit(limit)
+        return list((await db.execute(statement)).scalars())
+
+SEARCH_BACKENDS = {
+    "sqlite": SQLiteFTSBackend(),
+    "postgresql": PostgresSearchBackend(),
+}
+
+def get_search_backend(db) -> SearchBackend:
+    """Pick the backend for the database this session (sync or async) reads from"""
+    dialect = db.get_bind().dialect.name
+    return SEARCH_BACKENDS.get(dialect, LikeSearchBackend())
@@ -0,0 +1,54 @@
+# serialization.py
+import decimal
+from typing import Iterable, Optional, Set, Type, Union
+
+import orjson
+from fastapi import HTTPException, Response
+from pydantic import BaseModel
+
+from pagination import NEXT_CURSOR_HEADER
+
+# Fast path for large list pages: select only the columns a response schema
+# names, encode the rows with orjson and return the bytes. The routes keep
+# their response_model, which still documents the output, but FastAPI skips
+# validation for a returned Response, so the row values must already be
+# what the schema would produce.
+
+def columns(model, schema: Type[BaseModel]) -> list:
+    """The model's columns for every field of schema, to select rows instead of ORM objects"""
+    return [getattr(model, field) for field in schema.model_fields]
+
+def _encode_default(value):
+    # Numeric columns come back as Decimal; the schemas expose them as float
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps(value) -> bytes:
+    """orjson-encode value; UUIDs, datetimes and enums come out as Pydantic writes them"""
+    return orjson.dumps(value, default=_encode_default)
+
+def dump_rows(rows) -> bytes:
+    """JSON array of objects keyed by column name"""
+    return dumps([row._asdict() for row in rows])
+
+def json_response(body: Union[bytes, str], next_cursor: Optional[str] = None) -> Response:
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def parse_expand(expand: Optional[str], allowed: Iterable[str]) -> Set[str]:
+    """Paths from ?expand=a,b.c, each nested path with its parents; 400 for paths not in allowed"""
+    paths = set()
+    for path in filter(None, (part.strip() for part in (expand or "").split(","))):
+        if path not in allowed:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Cannot expand {path}; expected one of: {', '.join(allowed)}"
+            )
+        parts = path.split(".")
+        paths.update(".".join(parts[:depth]) for depth in range(1, len(parts) + 1))
+    return paths
+
+def subpaths(paths: Set[str], prefix: str) -> Set[str]:
+    """The paths below prefix, relative to it: subpaths({"bag", "bag.business"}, "bag") == {"business"}"""
+    return {path[len(prefix) + 1:] for path in paths if path.startswith(prefix + ".")}
@@ -0,0 +1,182 @@
+# tagging.py
+import asyncio
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from models import SurpriseBag
+
+logger = logging.getLogger(__name__)
+
+TAG_LIMIT = 5
+TITLE_WEIGHT = 2.0  # a word in the title counts as much as two in the description
+VOCABULARY_REFRESH_SECONDS = float(os.getenv("TAG_VOCABULARY_REFRESH_SECONDS", "600"))
+
+TOKEN_RE = re.compile(r"[^\W\d_]{3,}", re.UNICODE)
+STOPWORDS = {
+    "the", "and", "of", "to", "a", "in", "for", "with", "our", "your", "you",
+    "are", "from", "this", "that", "these", "all", "any", "some", "bag", "bags",
+    "surprise", "will", "can", "may", "not", "but", "has", "have", "its",
+}
+
+def tokenize(value: Optional[str]) -> List[str]:
+    return [token for token in TOKEN_RE.findall((value or "").lower()) if token not in STOPWORDS]
+
+def count_documents(db) -> Tuple[Counter, int]:
+    """Document frequency of every word over all bags' titles and descriptions, from a sync session"""
+    document_frequencies = Counter()
+    documents = 0
+    rows = db.execute(select(SurpriseBag.title, SurpriseBag.description).execution_options(yield_per=1000))
+    for title, description in rows:
+        document_frequencies.update(set(tokenize(title)) | set(tokenize(description)))
+        documents += 1
+    return document_frequencies, documents
+
+class TagVocabulary:
+    """Inverse document frequencies over the words used in existing bags"""
+
+    def __init__(self, terms: dict, idf: np.ndarray, documents: int):
+        self.terms = terms
+        self.idf = idf
+        self.documents = documents
+        # Smoothed idf of a word no existing bag uses: the rarest possible
+        self.unseen_idf = math.log(documents + 1) + 1.0
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls, document_frequencies: Counter, documents: int) -> "TagVocabulary":
+        terms = {term: index for index, term in enumerate(sorted(document_frequencies))}
+        frequencies = np.fromiter(
+            (document_frequencies[term] for term in terms), dtype=np.float64, count=len(terms)
+        )
+        idf = np.log((documents + 1) / (frequencies + 1)) + 1.0
+        return cls(terms, idf, documents)
+
+    @classmethod
+    def empty(cls) -> "TagVocabulary":
+        return cls({}, np.zeros(0), 0)
+
+    def recommend(self, pairs: Sequence[Tuple[str, Optional[str]]], limit: int = TAG_LIMIT) -> List[List[str]]:
+        """Top tags for every (title, description) pair, scored in one vectorized pass.
+
+        A tag's score is its weighted term frequency in the pair times its
+        idf; ties go to the alphabetically first word so results are stable.
+        """
+        doc_index, words, weights = [], [], []
+        for index, (title, description) in enumerate(pairs):
+            for word in tokenize(title):
+                doc_index.append(index)
+                words.append(word)
+                weights.append(TITLE_WEIGHT)
+            for word in tokenize(description):
+                doc_index.append(index)
+                words.append(word)
+                weights.append(1.0)
+
+        tags = [[] for _ in pairs]
+        if not words:
+            return tags
+
+        # Number the batch's words alphabetically so the id doubles as the tie-break
+        batch_terms, term_ids = np.unique(np.array(words), return_inverse=True)
+        batch_idf = np.array(
+            [self.idf[self.terms[term]] if term in self.terms else self.unseen_idf for term in batch_terms]
+        )
+
+        # Sum the weights of each (pair, word) occurrence
+        keys = np.asarray(doc_index, dtype=np.int64) * len(batch_terms) + term_ids
+        unique_keys, occurrence = np.unique(keys, return_inverse=True)
+        term_frequency = np.bincount(occurrence, weights=np.asarray(weights))
+        docs = unique_keys // len(batch_terms)
+        terms = unique_keys % len(batch_terms)
+        scores = term_frequency * batch_idf[terms]
+
+        order = np.lexsort((terms, -scores, docs))
+        docs, terms = docs[order], terms[order]
+        # Position of each candidate within its pair's ranking
+        group_start = np.searchsorted(docs, docs, side="left")
+        keep = (np.arange(len(docs)) - group_start) < limit
+        for doc, term in zip(docs[keep].tolist(), terms[keep].tolist()):
+            tags[doc].append(str(batch_terms[term]))
+        return tags
+
+class TagRecommender:
+    """Serves recommendations from a vocabulary rebuilt in the background.
+
+    Requests never wait for a rebuild: they score against the current
+    vocabulary and, when it is older than the refresh interval, kick off a
+    rebuild that swaps in when done. The API builds the first vocabulary at
+    startup (see routers/bags.py). Callers without an event loop, such as
+    Celery tasks, rebuild inline through the sync session instead.
+    """
+
+    def __init__(self, session_factory=None, refresh_seconds: float = VOCABULARY_REFRESH_SECONDS):
+        self.session_factory = session_factory
+        self.refresh_seconds = refresh_seconds
+        self.vocabulary = TagVocabulary.empty()
+        self._refreshed_at = None
+        self._refresh_task = None
+        self._build_lock = threading.Lock()
+
+    def recommend(self, pairs: Sequence[Tuple[str, Optional[str]]], limit: int = TAG_LIMIT) -> List[List[str]]:
+        self.schedule_refresh()
+        return self.vocabulary.recommend(pairs, limit)
+
+    def stale(self) -> bool:
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.refresh_seconds
+
+    def schedule_refresh(self):
+        if not self.stale() or (self._refresh_task and not self._refresh_task.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Worker threads wait for the first build rather than score
+            # against an empty vocabulary
+            with self._build_lock:
+                if self.stale():
+                    self.refresh_sync()
+                    self._refreshed_at = time.monotonic()
+            return
+        self._refreshed_at = time.monotonic()
+        self._refresh_task = loop.create_task(self.refresh())
+
+    async def startup(self):
+        """Build the first vocabulary before the API serves requests"""
+        self._refreshed_at = time.monotonic()
+        await self.refresh()
+
+    async def refresh(self):
+        """Rebuild the vocabulary from every bag's title and description"""
+        session_factory = self.session_factory
+        if session_factory is None:
+            from database import AsyncSessionLocal
+            session_factory = AsyncSessionLocal
+        try:
+            async with session_factory() as db:
+                document_frequencies, documents = await db.run_sync(count_documents)
+            self.vocabulary = await asyncio.to_thread(TagVocabulary.build, document_frequencies, documents)
+            logger.info(f"Tag vocabulary rebuilt: {len(self.vocabulary.terms)} terms from {documents} bags")
+        except Exception as e:
+            logger.error(f"Error rebuilding tag vocabulary: {str(e)}")
+
+    def refresh_sync(self):
+        """refresh() for callers with no event loop, through the sync SessionLocal"""
+        from database import SessionLocal
+        try:
+            with SessionLocal() as db:
+                document_frequencies, documents = count_documents(db)
+            self.vocabulary = TagVocabulary.build(document_frequencies, documents)
+            logger.info(f"Tag vocabulary rebuilt: {len(self.vocabulary.terms)} terms from {documents} bags")
+        except Exception as e:
+            logger.error(f"Error rebuilding tag vocabulary: {str(e)}")
+
+tag_recommender = TagRecommender()
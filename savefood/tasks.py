@@ -1,68 +1,491 @@
 # tasks.py
 from celery_config import celery_app
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import SurpriseBag, Notification, User, NotificationType, Order  # Added Order import
-from database import DATABASE_URL
+from celery.signals import worker_process_init
+from models import SurpriseBag, Notification, NotificationArchive, BusinessRating, User, NotificationType, Order, BagTemplate, utcnow  # Added Order import
+from database import SessionLocal, engine, upsert
+from search import get_search_backend
+from catalog import bump_versions
+from tagging import tag_recommender
+from dispatch import dispatcher
+from notification_hub import notification_hub, notification_event
+from sqlalchemy import bindparam, case, delete, func, insert, select, update
+from datetime import datetime, timedelta, timezone
 import logging
-
-# Database setup for Celery
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+import os
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", "500"))  # payloads per bulk task message
+NOTIFICATION_INSERT_CHUNK = int(os.getenv("NOTIFICATION_INSERT_CHUNK", "1000"))  # rows per INSERT statement
+REMINDER_LEAD_MINUTES = int(os.getenv("REMINDER_LEAD_MINUTES", "60"))  # how long before pickup ends to remind
+OPEN_ORDER_STATUSES = ["pending", "confirmed"]
+
+# Notification retention: read notifications older than the retention
+# period are archived (or deleted) in short batches, each its own
+# transaction, so the writer lock is released between batches
+NOTIFICATION_RETENTION_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS", "90"))
+NOTIFICATION_RETENTION_MODE = os.getenv("NOTIFICATION_RETENTION_MODE", "archive")  # archive or delete
+NOTIFICATION_PURGE_BATCH = int(os.getenv("NOTIFICATION_PURGE_BATCH", "500"))
+NOTIFICATION_PURGE_MAX_BATCHES = int(os.getenv("NOTIFICATION_PURGE_MAX_BATCHES", "200"))  # per run
+NOTIFICATION_PURGE_PAUSE_SECONDS = float(os.getenv("NOTIFICATION_PURGE_PAUSE_SECONDS", "0.05"))
+SEARCH_REINDEX_CHUNK = int(os.getenv("SEARCH_REINDEX_CHUNK", "1000"))  # bags tagged and indexed per INSERT
+TEMPLATE_DAYS_AHEAD = int(os.getenv("TEMPLATE_DAYS_AHEAD", "1"))  # days after today to post template bags for
+
+@worker_process_init.connect
+def reset_db_pool(**kwargs):
+    """Drop connections inherited from the parent after a worker fork"""
+    engine.dispose(close=False)
+
 @celery_app.task
 def send_notification(user_id: str, title: str, message: str, type: str, order_id: str = None):
     """Send a notification to a user"""
+    return send_notifications_bulk([
+        {"user_id": user_id, "title": title, "message": message, "type": type, "order_id": order_id}
+    ])
+
+def notification_row(payload: dict) -> dict:
+    """Validate one payload and turn it into a notifications row"""
+    return {
+        "id": uuid.uuid4(),
+        "user_id": uuid.UUID(str(payload["user_id"])),
+        "order_id": uuid.UUID(str(payload["order_id"])) if payload.get("order_id") else None,
+        "type": NotificationType(payload["type"]),
+        "title": payload["title"],
+        "message": payload["message"]
+    }
+
+def publish_notifications(rows: list):
+    """Push freshly committed notification rows to their users' live streams"""
+    notification_hub.publish_many_threadsafe(
+        [(row["user_id"], notification_event(**row)) for row in rows]
+    )
+
+@celery_app.task
+def send_notifications_bulk(payloads: list):
+    """Send many notifications with multi-row INSERTs, NOTIFICATION_INSERT_CHUNK rows per statement.
+
+    Each payload carries send_notification's arguments. A bad payload or a
+    row the database rejects fails on its own; the result lists failures
+    by payload index.
+    """
+    rows, failed = [], []
+    for index, payload in enumerate(payloads):
+        try:
+            rows.append((index, notification_row(payload)))
+        except (KeyError, TypeError, ValueError) as e:
+            failed.append({"index": index, "error": f"Invalid payload: {str(e)}"})
+
+    sent = 0
     db = SessionLocal()
     try:
-        notification = Notification(
-            user_id=user_id,
-            order_id=order_id,
-            type=NotificationType(type),
-            title=title,
-            message=message
+        for start in range(0, len(rows), NOTIFICATION_INSERT_CHUNK):
+            chunk = rows[start:start + NOTIFICATION_INSERT_CHUNK]
+            try:
+                db.execute(insert(Notification), [row for _, row in chunk])
+                db.commit()
+                sent += len(chunk)
+                publish_notifications([row for _, row in chunk])
+            except Exception as e:
+                db.rollback()
+                logger.warning(f"Notification chunk failed, retrying row by row: {str(e)}")
+                # Find the offending rows without losing the rest of the chunk
+                for index, row in chunk:
+                    try:
+                        db.execute(insert(Notification), [row])
+                        db.commit()
+                        sent += 1
+                        publish_notifications([row])
+                    except Exception as e:
+                        db.rollback()
+                        failed.append({"index": index, "error": str(getattr(e, "orig", e))})
+    finally:
+        db.close()
+
+    if failed:
+        logger.error(f"Sent {sent} notifications, {len(failed)} failed")
+    else:
+        logger.info(f"Sent {sent} notifications")
+    return {"sent": sent, "failed": failed}
+
+def reminder_payload(order_id, customer_id, pickup_end) -> dict:
+    return {
+        "user_id": str(customer_id),
+        "title": "Pickup Reminder",
+        "message": f"Your surprise bag pickup ends at {pickup_end}",
+        "type": "pickup_reminder",
+        "order_id": str(order_id)
+    }
+
+def claim_pickup_reminders(db, *criteria):
+    """Mark open, not yet reminded orders matching criteria as reminded.
+
+    The conditional UPDATE is the dedupe: whichever task claims an order
+    first sends its reminder, later or duplicate deliveries claim nothing.
+    Returns (order_id, customer_id) of the claimed orders.
+    """
+    return db.execute(
+        update(Order)
+        .where(
+            Order.reminder_sent_at.is_(None),
+            Order.status.in_(OPEN_ORDER_STATUSES),
+            Order.customer_id.isnot(None),
+            *criteria
+        )
+        .values(reminder_sent_at=datetime.utcnow())
+        .returning(Order.id, Order.customer_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+def schedule_pickup_reminders(bag_id, pickup_end: datetime, order_id=None):
+    """Queue the reminder for one order, or for every open order of the bag, REMINDER_LEAD_MINUTES before pickup ends"""
+    now = datetime.utcnow()
+    if pickup_end <= now:
+        return
+    eta = max(pickup_end - timedelta(minutes=REMINDER_LEAD_MINUTES), now)
+    try:
+        dispatcher.submit(
+            send_pickup_reminders,
+            str(bag_id), pickup_end.isoformat(), str(order_id) if order_id else None,
+            eta=eta.replace(tzinfo=timezone.utc)
         )
-        db.add(notification)
+    except Exception as e:
+        logger.error(f"Error scheduling pickup reminder for bag {bag_id}: {str(e)}")
+
+@celery_app.task
+def send_pickup_reminders(bag_id: str, pickup_end: str, order_id: str = None):
+    """Remind customers with open orders on a bag that pickup ends soon.
+
+    pickup_end is the value the reminder was scheduled for; if the bag's
+    pickup_end has changed since, this delivery is stale and does nothing
+    (the update scheduled a new one). Cancelled and completed orders are
+    skipped by the claim.
+    """
+    db = SessionLocal()
+    try:
+        criteria = [Order.bag_id.in_(
+            select(SurpriseBag.id).where(
+                SurpriseBag.id == uuid.UUID(bag_id),
+                SurpriseBag.pickup_end == datetime.fromisoformat(pickup_end),
+                SurpriseBag.is_active == True
+            )
+        )]
+        if order_id:
+            criteria.append(Order.id == uuid.UUID(order_id))
+        claimed = claim_pickup_reminders(db, *criteria)
+        rows = [
+            notification_row(reminder_payload(claimed_id, customer_id, pickup_end))
+            for claimed_id, customer_id in claimed
+        ]
+        if rows:
+            # Same transaction as the claim: a reminder is marked sent only if it was written
+            db.execute(insert(Notification), rows)
         db.commit()
-        logger.info(f"Notification sent to user {user_id}: {title}")
+        publish_notifications(rows)
+        logger.info(f"Sent {len(claimed)} pickup reminders for bag {bag_id}")
     except Exception as e:
         db.rollback()
-        logger.error(f"Error sending notification: {str(e)}")
+        logger.error(f"Error sending pickup reminders: {str(e)}")
     finally:
         db.close()
 
 @celery_app.task
 def check_expiring_bags():
-    """Check for bags nearing pickup end time and notify customers"""
+    """Catch-up sweep: remind open orders on bags nearing pickup end that have no reminder yet.
+
+    Reminders are scheduled per order as it is placed; run this after the
+    broker has been unavailable to cover any that were lost.
+    """
     db = SessionLocal()
+    claims = SessionLocal()
     try:
-        from datetime import datetime, timedelta
         now = datetime.utcnow()
-        threshold = now + timedelta(hours=1)
+        threshold = now + timedelta(minutes=REMINDER_LEAD_MINUTES)
         
-        expiring_bags = db.query(SurpriseBag).filter(
-            SurpriseBag.pickup_end.between(now, threshold),
-            SurpriseBag.is_active == True
-        ).all()
+        # One joined query for every open order on an expiring bag, streamed
+        # in chunks; each chunk is claimed and written in one transaction
+        rows = db.execute(
+            select(Order.id, Order.customer_id, SurpriseBag.pickup_end)
+            .join(SurpriseBag, Order.bag_id == SurpriseBag.id)
+            .where(
+                SurpriseBag.pickup_end.between(now, threshold),
+                SurpriseBag.is_active == True,
+                Order.status.in_(OPEN_ORDER_STATUSES),
+                Order.customer_id.isnot(None),
+                Order.reminder_sent_at.is_(None)
+            )
+            .execution_options(yield_per=NOTIFICATION_BATCH_SIZE)
+        )
         
-        for bag in expiring_bags:
-            orders = db.query(Order).filter(
-                Order.bag_id == bag.id,
-                Order.status.in_(["pending", "confirmed"])
-            ).all()
-            
-            for order in orders:
-                send_notification.delay(
-                    str(order.customer_id),
-                    "Pickup Reminder",
-                    f"Your surprise bag pickup ends at {bag.pickup_end}",
-                    "pickup_reminder",
-                    str(order.id)
-                )
+        sent = 0
+        for chunk in rows.partitions():
+            pickup_ends = {order_id: pickup_end for order_id, _, pickup_end in chunk}
+            claimed = claim_pickup_reminders(claims, Order.id.in_(list(pickup_ends)))
+            notifications = [
+                notification_row(reminder_payload(order_id, customer_id, pickup_ends[order_id]))
+                for order_id, customer_id in claimed
+            ]
+            if notifications:
+                # As in send_pickup_reminders: an order is only marked
+                # reminded together with its notification
+                claims.execute(insert(Notification), notifications)
+            claims.commit()
+            publish_notifications(notifications)
+            sent += len(notifications)
+        logger.info(f"Sent {sent} catch-up pickup reminders")
     except Exception as e:
         db.rollback()
+        claims.rollback()
         logger.error(f"Error checking expiring bags: {str(e)}")
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+        claims.close()
+
+@celery_app.task
+def purge_notifications():
+    """Enforce notification retention; returns the rows processed in this run"""
+    if NOTIFICATION_RETENTION_MODE not in ("archive", "delete"):
+        raise ValueError(f"Unknown NOTIFICATION_RETENTION_MODE: {NOTIFICATION_RETENTION_MODE}")
+    cutoff = datetime.utcnow() - timedelta(days=NOTIFICATION_RETENTION_DAYS)
+    expired = (Notification.is_read == True, Notification.created_at < cutoff)
+    columns = ["id", "user_id", "order_id", "type", "title", "message", "is_read", "created_at"]
+
+    processed = 0
+    batches = 0
+    db = SessionLocal()
+    try:
+        while batches < NOTIFICATION_PURGE_MAX_BATCHES:
+            ids = db.execute(
+                select(Notification.id).where(*expired)
+                .order_by(Notification.created_at)
+                .limit(NOTIFICATION_PURGE_BATCH)
+            ).scalars().all()
+            if not ids:
+                break
+            # Conditions are repeated so a notification marked unread
+            # since the SELECT stays put
+            batch = (Notification.id.in_(ids), *expired)
+            if NOTIFICATION_RETENTION_MODE == "archive":
+                db.execute(insert(NotificationArchive).from_select(
+                    columns,
+                    select(*(getattr(Notification, column) for column in columns)).where(*batch)
+                ))
+            result = db.execute(delete(Notification).where(*batch).execution_options(synchronize_session=False))
+            db.commit()
+            processed += result.rowcount
+            batches += 1
+            if len(ids) < NOTIFICATION_PURGE_BATCH:
+                break
+            time.sleep(NOTIFICATION_PURGE_PAUSE_SECONDS)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error purging notifications: {str(e)}")
+    finally:
+        db.close()
+
+    logger.info(
+        f"Notification retention: {processed} rows {NOTIFICATION_RETENTION_MODE}d "
+        f"in {batches} batches (older than {NOTIFICATION_RETENTION_DAYS} days)"
+    )
+    return {"mode": NOTIFICATION_RETENTION_MODE, "processed": processed, "batches": batches}
+
+@celery_app.task
+def backfill_order_businesses():
+    """Copy each bag's business_id onto orders placed before orders carried it.
+
+    Runs at API startup (see routers/orders.py) so shop owners see their
+    older orders at once; when every order has one it is a single
+    indexed lookup that changes nothing.
+    """
+    db = SessionLocal()
+    try:
+        orders = Order.__table__
+        assigned = db.execute(
+            orders.update().where(orders.c.business_id.is_(None)).values(
+                business_id=select(SurpriseBag.business_id).where(SurpriseBag.id == orders.c.bag_id).scalar_subquery()
+            )
+        ).rowcount
+        db.commit()
+        if assigned:
+            logger.info(f"Assigned {assigned} orders to their business")
+        return assigned
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error backfilling order businesses: {str(e)}")
+    finally:
+        db.close()
+
+@celery_app.task
+def rebuild_business_ratings():
+    """Recompute business_ratings from rated orders, for the initial backfill or to repair drift"""
+    db = SessionLocal()
+    try:
+        # Reviews written before reviewed_at existed: date them by their last update
+        orders = Order.__table__
+        undated = db.execute(
+            select(Order.id, Order.updated_at, Order.created_at)
+            .where(Order.rating.isnot(None), Order.reviewed_at.is_(None))
+        ).all()
+        if undated:
+            db.execute(
+                orders.update().where(orders.c.id == bindparam("order_id")).values(reviewed_at=bindparam("reviewed")),
+                [{"order_id": order_id, "reviewed": updated_at or created_at} for order_id, updated_at, created_at in undated]
+            )
+
+        buckets = [func.sum(case((Order.rating == rating, 1), else_=0)) for rating in range(1, 6)]
+        totals = (
+            select(SurpriseBag.business_id, func.count(Order.rating), func.sum(Order.rating), *buckets)
+            .join(SurpriseBag, Order.bag_id == SurpriseBag.id)
+            .where(Order.rating.isnot(None))
+            .group_by(SurpriseBag.business_id)
+        )
+        db.execute(delete(BusinessRating))
+        db.execute(insert(BusinessRating).from_select(
+            ["business_id", "rating_count", "rating_sum", "rating_1", "rating_2", "rating_3", "rating_4", "rating_5"],
+            totals
+        ))
+        db.commit()
+        logger.info(f"Rebuilt business ratings, dated {len(undated)} legacy reviews")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error rebuilding business ratings: {str(e)}")
+    finally:
+        db.close()
+
+@celery_app.task
+def rebuild_search_index():
+    """Re-index every bag, for bags written before the search index existed or to repair drift.
+
+    The index is emptied and refilled in one transaction, so searches keep
+    reading the old index until the new one commits.
+    """
+    db = SessionLocal()
+    try:
+        backend = get_search_backend(db)
+        clear = backend.clear_index()
+        if clear is None:
+            return 0
+        db.execute(clear)
+        indexed = 0
+        rows = db.execute(
+            select(SurpriseBag.id, SurpriseBag.title, SurpriseBag.description)
+            .execution_options(yield_per=SEARCH_REINDEX_CHUNK)
+        )
+        for chunk in rows.partitions():
+            tags = tag_recommender.recommend([(bag.title, bag.description) for bag in chunk])
+            db.execute(*backend.new_bags_insert(chunk, tags))
+            indexed += len(chunk)
+        db.commit()
+        logger.info(f"Rebuilt search index over {indexed} bags")
+        return indexed
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error rebuilding search index: {str(e)}")
+    finally:
+        db.close()
+
+@celery_app.task
+def deactivate_expired_bags():
+    """Switch off every active bag whose pickup window has closed, in one UPDATE"""
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            update(SurpriseBag)
+            .where(SurpriseBag.is_active == True, SurpriseBag.pickup_end <= datetime.utcnow())
+            .values(is_active=False, version=SurpriseBag.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            db.execute(*bump_versions(db, "bag"))
+        db.commit()
+        logger.info(f"Deactivated {result.rowcount} expired bags")
+        return result.rowcount
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error deactivating expired bags: {str(e)}")
+    finally:
+        db.close()
+
+def template_bags(templates, days, now: datetime) -> list:
+    """SurpriseBag rows for every template running on each day, skipping windows already closed"""
+    rows = []
+    for day in days:
+        for template in templates:
+            if not template.runs_on(day):
+                continue
+            pickup_start = datetime.combine(day, template.pickup_start_time)
+            pickup_end = datetime.combine(day, template.pickup_end_time)
+            if pickup_end <= pickup_start:
+                pickup_end += timedelta(days=1)
+            if pickup_end <= now:
+                continue
+            rows.append(SurpriseBag(
+                id=uuid.uuid4(),
+                business_id=template.business_id,
+                template_id=template.id,
+                template_date=day,
+                title=template.title,
+                description=template.description,
+                original_price=template.original_price,
+                discount_price=template.discount_price,
+                quantity_available=template.quantity_available,
+                quantity_sold=0,
+                pickup_start=pickup_start,
+                pickup_end=pickup_end,
+                image_urls=template.image_urls,
+                is_active=True,
+                version=1,
+                created_at=now,
+            ))
+    return rows
+
+@celery_app.task
+def materialize_bag_templates():
+    """Post the bags of every active template, from yesterday to TEMPLATE_DAYS_AHEAD days out.
+
+    Safe to run any number of times: (template_id, template_date) is
+    unique and conflicting rows are skipped. Each run covers every day
+    whose pickup window is still open, so a run after downtime catches up;
+    days that closed while nothing ran are not posted.
+    """
+    now = utcnow()
+    days = [now.date() + timedelta(days=offset) for offset in range(-1, TEMPLATE_DAYS_AHEAD + 1)]
+    db = SessionLocal()
+    try:
+        templates = db.execute(
+            select(BagTemplate).where(BagTemplate.is_active == True)
+        ).scalars().all()
+        bags = template_bags(templates, days, now)
+        if not bags:
+            return 0
+
+        columns = SurpriseBag.__table__.columns
+        result = db.execute(
+            upsert(db, SurpriseBag.__table__).on_conflict_do_nothing().returning(SurpriseBag.id),
+            [{column.key: getattr(bag, column.key) for column in columns} for bag in bags]
+        )
+        created_ids = set(result.scalars())
+        created = [bag for bag in bags if bag.id in created_ids]
+        index = get_search_backend(db).new_bags_insert(
+            created, tag_recommender.recommend([(bag.title, bag.description) for bag in created])
+        )
+        if index:
+            db.execute(*index)
+        if created:
+            db.execute(*bump_versions(db, "bag"))
+        db.commit()
+        logger.info(f"Posted {len(created)} template bags for {len(templates)} templates")
+        return len(created)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error posting template bags: {str(e)}")
+    finally:
+        db.close()
+
+def schedule_template_materialization():
+    """Post new templates' bags now rather than at the next beat run; the beat catches up if this fails"""
+    try:
+        dispatcher.submit(materialize_bag_templates)
+    except Exception as e:
+        logger.error(f"Error scheduling template materialization: {str(e)}")
@@ -2,19 +2,26 @@
 import pytest
 import uuid
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from jose import jwt
 from datetime import datetime, timedelta, UTC
 import logging
 import os
+import tempfile
+import asyncio
+import httpx
 
 from main import app
-from database import Base, get_db
-from models import User, UserRole, SurpriseBag, Business
+from celery_config import celery_app
+from database import Base, get_async_db, to_async_url
+from models import User, UserRole, SurpriseBag, Business, Order, OrderStatus, BusinessDailySales
 from routers.auth import (
     get_password_hash, 
     create_access_token,
+    user_cache,
     SECRET_KEY,
     ALGORITHM
 )
@@ -22,14 +29,24 @@ from routers.auth import (
 # Initialize TestClient
 client = TestClient(app)
 
+# Orders schedule pickup reminders through Celery; keep them off Redis
+celery_app.conf.update(broker_url="memory://", result_backend="cache+memory://")
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Database setup - use in-memory SQLite for tests
-TEST_DATABASE_URL = "sqlite:///:memory:"
+# Database setup - a temporary SQLite file shared by the sync fixtures and
+# the async sessions the routers use
+TEST_DATABASE_URL = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
 test_engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
+test_async_engine = create_async_engine(to_async_url(TEST_DATABASE_URL), poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(test_async_engine, autoflush=False, expire_on_commit=False)
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
 
 # Create tables once at module level
 @pytest.fixture(scope="module", autouse=True)
@@ -40,15 +57,18 @@ def setup_database():
 
 @pytest.fixture
 def db_session():
-    connection = test_engine.connect()
-    transaction = connection.begin()
-    session = TestingSessionLocal(bind=connection)
+    session = TestingSessionLocal()
     
     yield session
     
+    # The app commits through its own connections, so clean up table by table
+    session.rollback()
+    for table in reversed(Base.metadata.sorted_tables):
+        session.execute(table.delete())
+    session.commit()
     session.close()
-    transaction.rollback()
-    connection.close()
+    # Users are recreated with the same emails but new ids
+    user_cache.clear()
 
 @pytest.fixture
 def test_customer(db_session):
@@ -132,14 +152,8 @@ def test_bag(db_session, test_business_owner):
 def test_create_order(test_customer, test_bag, db_session):
     """Test creating an order"""
     try:
-        # Override get_db dependency
-        def override_get_db():
-            try:
-                yield db_session
-            finally:
-                pass
-        
-        app.dependency_overrides[get_db] = override_get_db
+        # Override get_async_db dependency
+        app.dependency_overrides[get_async_db] = override_get_async_db
         
         # Verify customer exists in DB
         customer_check = db_session.query(User).filter(User.email == test_customer.email).first()
@@ -178,4 +192,286 @@ def test_create_order(test_customer, test_bag, db_session):
         raise
     finally:
         # Cleanup
-        app.dependency_overrides.clear()
\ No newline at end of file
+        app.dependency_overrides.clear()
+
+def test_concurrent_orders_do_not_oversell(tmp_path):
+    """Fire parallel orders at one bag and check stock is never oversold"""
+    stock = 50
+    attempts = 300
+
+    # A separate database so every request gets its own connection and transaction
+    stress_url = f"sqlite:///{tmp_path / 'stress.db'}"
+    stress_engine = create_engine(stress_url, connect_args={"check_same_thread": False})
+    StressSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=stress_engine)
+    stress_async_engine = create_async_engine(
+        to_async_url(stress_url), poolclass=NullPool, connect_args={"timeout": 30}
+    )
+    StressAsyncSessionLocal = async_sessionmaker(stress_async_engine, autoflush=False, expire_on_commit=False)
+    Base.metadata.create_all(bind=stress_engine)
+
+    seed = StressSessionLocal()
+    password_hash = get_password_hash("testpassword123")
+    owner = User(
+        id=uuid.uuid4(),
+        email="stress-owner@test.com",
+        password_hash=password_hash,
+        name="Stress Owner",
+        role=UserRole.business_owner
+    )
+    seed.add(owner)
+    seed.add(Business(id=owner.id, name="Stress Business", is_approved=True))
+    customers = [
+        User(
+            id=uuid.uuid4(),
+            email=f"stress-{i}@test.com",
+            password_hash=password_hash,
+            name=f"Stress Customer {i}",
+            role=UserRole.customer
+        )
+        for i in range(20)
+    ]
+    seed.add_all(customers)
+    bag = SurpriseBag(
+        business_id=owner.id,
+        title="Popular Bag",
+        original_price=10.0,
+        discount_price=5.0,
+        quantity_available=stock,
+        quantity_sold=0,
+        pickup_start=datetime.now(UTC),
+        pickup_end=datetime.now(UTC) + timedelta(hours=1),
+        is_active=True
+    )
+    seed.add(bag)
+    seed.commit()
+    bag_id = bag.id
+    tokens = [create_access_token({"sub": c.email}) for c in customers]
+    seed.close()
+
+    async def override_stress_db():
+        async with StressAsyncSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_async_db] = override_stress_db
+
+    async def place_orders():
+        # All requests share one event loop, as they would on a uvicorn worker
+        gate = asyncio.Semaphore(32)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as stress_client:
+            async def place_order(i):
+                headers = {"Authorization": f"Bearer {tokens[i % len(tokens)]}"}
+                async with gate:
+                    response = await stress_client.post(
+                        "/orders/", json={"bag_id": str(bag_id), "quantity": 1}, headers=headers
+                    )
+                return response.status_code
+            return await asyncio.gather(*(place_order(i) for i in range(attempts)))
+
+    try:
+        codes = asyncio.run(place_orders())
+    finally:
+        app.dependency_overrides.clear()
+
+    check = StressSessionLocal()
+    try:
+        bag = check.query(SurpriseBag).filter(SurpriseBag.id == bag_id).one()
+        ordered = check.query(Order).filter(Order.bag_id == bag_id).all()
+
+        assert codes.count(201) == stock
+        assert codes.count(400) == attempts - stock
+        assert len(ordered) == stock
+        assert bag.quantity_available == 0
+        assert bag.quantity_sold == stock
+        assert bag.quantity_available + sum(o.quantity for o in ordered) == stock
+    finally:
+        check.close()
+        stress_engine.dispose()
+
+def test_expanded_orders_use_constant_queries(test_customer, test_business_owner, db_session):
+    """Embedding bags and shops with ?expand= costs the same queries for one order or many"""
+    owner_id = test_business_owner.id
+    customer_id = test_customer.id
+    now = datetime.now(UTC)
+
+    def add_orders(count):
+        for _ in range(count):
+            bag = SurpriseBag(
+                business_id=owner_id,
+                title="Expanded Bag",
+                original_price=10.0,
+                discount_price=5.0,
+                quantity_available=10,
+                quantity_sold=0,
+                pickup_start=now,
+                pickup_end=now + timedelta(hours=1),
+                is_active=True
+            )
+            db_session.add(bag)
+            db_session.flush()
+            db_session.add(Order(
+                customer_id=customer_id,
+                bag_id=bag.id,
+                quantity=1,
+                total_price=5.0,
+                pickup_code=uuid.uuid4().hex[:8]
+            ))
+        db_session.commit()
+
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    event.listen(test_async_engine.sync_engine, "before_cursor_execute", count_statement)
+    try:
+        headers = {"Authorization": f"Bearer {create_access_token({'sub': test_customer.email})}"}
+
+        def fetch_orders():
+            statements.clear()
+            response = client.get("/orders/?expand=bag.business", headers=headers)
+            assert response.status_code == 200, response.text
+            return response.json(), len(statements)
+
+        add_orders(1)
+        fetch_orders()  # warm the user cache so authentication does not add queries
+        orders, single_queries = fetch_orders()
+        assert len(orders) == 1
+
+        add_orders(9)
+        orders, many_queries = fetch_orders()
+        assert len(orders) == 10
+        assert many_queries == single_queries
+        # orders, then their bags, then the bags' businesses
+        assert many_queries == 3
+        for order in orders:
+            assert order["bag"]["id"] == order["bag_id"]
+            assert order["bag"]["business"]["id"] == str(owner_id)
+            assert order["bag"]["business"]["name"] == "Test Business"
+
+        statements.clear()
+        response = client.get(f"/orders/{orders[0]['id']}?expand=bag.business", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["bag"]["business"]["name"] == "Test Business"
+        assert len(statements) == 3
+    finally:
+        event.remove(test_async_engine.sync_engine, "before_cursor_execute", count_statement)
+        app.dependency_overrides.clear()
+
+def add_order(db_session, customer, bag, status, quantity=2):
+    order = Order(
+        customer_id=customer.id,
+        bag_id=bag.id,
+        business_id=bag.business_id,
+        quantity=quantity,
+        total_price=5.0 * quantity,
+        status=status,
+        pickup_code=uuid.uuid4().hex[:8]
+    )
+    db_session.add(order)
+    db_session.commit()
+    return order.id
+
+@pytest.mark.parametrize("action, start, expected_code, end", [
+    ("confirm", OrderStatus.pending, 200, OrderStatus.confirmed),
+    ("confirm", OrderStatus.confirmed, 404, OrderStatus.confirmed),
+    ("confirm", OrderStatus.completed, 404, OrderStatus.completed),
+    ("confirm", OrderStatus.cancelled, 404, OrderStatus.cancelled),
+    ("complete", OrderStatus.pending, 404, OrderStatus.pending),
+    ("complete", OrderStatus.confirmed, 200, OrderStatus.completed),
+    ("complete", OrderStatus.completed, 404, OrderStatus.completed),
+    ("complete", OrderStatus.cancelled, 404, OrderStatus.cancelled),
+    ("cancel", OrderStatus.pending, 200, OrderStatus.cancelled),
+    ("cancel", OrderStatus.confirmed, 200, OrderStatus.cancelled),
+    ("cancel", OrderStatus.completed, 409, OrderStatus.completed),
+    ("cancel", OrderStatus.cancelled, 409, OrderStatus.cancelled),
+])
+def test_order_transitions_from_each_status(
+    action, start, expected_code, end, test_customer, test_business_owner, test_bag, db_session
+):
+    """Each transition only moves orders out of the status it expects; stock and sales follow the winners"""
+    order_id = add_order(db_session, test_customer, test_bag, start)
+    stock = test_bag.quantity_available
+    # Customers cancel their orders, the shop confirms and completes them
+    user = test_customer if action == "cancel" else test_business_owner
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': user.email})}"}
+
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    try:
+        response = client.put(f"/orders/{order_id}/{action}", headers=headers)
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == expected_code, response.text
+    db_session.expire_all()
+    assert db_session.get(Order, order_id).status == end
+    restocked = action == "cancel" and expected_code == 200
+    assert db_session.get(SurpriseBag, test_bag.id).quantity_available == stock + (2 if restocked else 0)
+    sales = db_session.query(BusinessDailySales).all()
+    if expected_code != 200:
+        assert sales == []
+    else:
+        counter = {"confirm": "confirmed_orders", "complete": "completed_orders", "cancel": "cancelled_orders"}[action]
+        assert len(sales) == 1 and getattr(sales[0], counter) == 1
+
+def test_concurrent_transitions_apply_once(test_customer, test_business_owner, test_bag, db_session):
+    """Parallel confirms, completes and cancels of one order: one of each wins and stock comes back once"""
+    burst = 8
+    confirmed_id = add_order(db_session, test_customer, test_bag, OrderStatus.pending)
+    cancelled_id = add_order(db_session, test_customer, test_bag, OrderStatus.confirmed, quantity=3)
+    stock = test_bag.quantity_available
+    owner = {"Authorization": f"Bearer {create_access_token({'sub': test_business_owner.email})}"}
+    customer = {"Authorization": f"Bearer {create_access_token({'sub': test_customer.email})}"}
+
+    async def put_burst(path, headers):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as burst_client:
+            responses = await asyncio.gather(*(burst_client.put(path, headers=headers) for _ in range(burst)))
+        return [response.status_code for response in responses]
+
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    try:
+        confirms = asyncio.run(put_burst(f"/orders/{confirmed_id}/confirm", owner))
+        completes = asyncio.run(put_burst(f"/orders/{confirmed_id}/complete", owner))
+        cancels = asyncio.run(put_burst(f"/orders/{cancelled_id}/cancel", customer))
+    finally:
+        app.dependency_overrides.clear()
+
+    # Losers either saw the new status already (404) or lost the conditional UPDATE (409)
+    for codes in (confirms, completes):
+        assert codes.count(200) == 1
+        assert set(codes) <= {200, 404, 409}
+    assert cancels.count(200) == 1
+    assert set(cancels) <= {200, 409}
+
+    db_session.expire_all()
+    assert db_session.get(Order, confirmed_id).status == OrderStatus.completed
+    assert db_session.get(Order, cancelled_id).status == OrderStatus.cancelled
+    assert db_session.get(SurpriseBag, test_bag.id).quantity_available == stock + 3
+    sales = db_session.query(BusinessDailySales).one()
+    assert (sales.confirmed_orders, sales.completed_orders, sales.cancelled_orders) == (1, 1, 1)
+    assert sales.units_sold == 2
+    assert float(sales.revenue) == 10.0
+
+def test_stats_are_admin_only(test_customer, db_session):
+    """Pool and cache counters are served to admins and hidden from everyone else"""
+    admin = User(
+        id=uuid.uuid4(), email="admin@test.com", password_hash=get_password_hash("testpassword123"),
+        name="Test Admin", role=UserRole.admin, is_active=True
+    )
+    db_session.add(admin)
+    db_session.commit()
+
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    try:
+        customer = {"Authorization": f"Bearer {create_access_token({'sub': test_customer.email})}"}
+        assert client.get("/users/stats", headers=customer).status_code == 403
+        response = client.get("/users/stats", headers={"Authorization": f"Bearer {create_access_token({'sub': admin.email})}"})
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    stats = response.json()
+    assert "async" in stats["database"]
+    assert {"checkouts", "wait_max_ms", "timeouts"} <= stats["database"]["async"].keys()
+    assert stats["cache"]["backend"]